@@ -0,0 +1,260 @@
+#!/usr/bin/python3
+# -*- coding: utf-8
+
+'''
+Analysis of the game history log, stored by column in compact arrays.
+
+Columns are extracted from packed records by slicing, and statistics are
+computed by functions which run in C: sorting, counting, and searching
+bytes. A history of a million games loads and is analyzed in a fraction
+of a second.
+'''
+
+from array import array
+from bisect import bisect_left
+import calendar
+from collections import Counter, namedtuple
+from itertools import accumulate, compress
+import sys
+import time
+
+import history
+
+__all__ = [
+    'PERIODS', 'Columns', 'Streaks', 'longest_run', 'period_starts',
+]
+
+# Periods for which win_rates may be computed. Weeks begin on Monday.
+PERIODS = ('day', 'week', 'month')
+
+_DAY = 86400
+
+# Day of the week of the epoch, counting from Monday
+_EPOCH_WEEKDAY = 3
+
+_WON = bytes([history.WON])
+_LOST = bytes([history.LOST])
+
+Streaks = namedtuple('Streaks', 'current longest_won longest_lost')
+Streaks.__doc__ = '''
+Streaks of games: current is the number of games won in a row at the end
+of history, or the negative number of games lost; the others are
+the longest runs of games won and lost
+'''
+
+def longest_run(data, b):
+    '''
+    Returns the length of the longest run of bytes b in data
+    '''
+    # Binary search, each step of which is a search of data
+    lo, hi = 0, len(data)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if b * mid in data:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def period_starts(period, first, last, utc_offset):
+    '''
+    Yields the start time of each period which contains times from first
+    to last, in seconds from the epoch; periods begin at midnight of UTC
+    plus utc_offset seconds
+    '''
+    day = (first + utc_offset) // _DAY
+
+    if period == 'day':
+        t = day * _DAY - utc_offset
+        step = _DAY
+    elif period == 'week':
+        t = (day - (day + _EPOCH_WEEKDAY) % 7) * _DAY - utc_offset
+        step = 7 * _DAY
+    elif period == 'month':
+        tm = time.gmtime(day * _DAY)
+        year, month = tm.tm_year, tm.tm_mon
+        while True:
+            t = calendar.timegm((year, month, 1, 0, 0, 0)) - utc_offset
+            if t > last:
+                return
+            yield t
+            year, month = divmod(year * 12 + month, 12)
+            month += 1
+    else:
+        raise ValueError('unknown period: {}'.format(period))
+
+    while t <= last:
+        yield t
+        t += step
+
+class Columns(object):
+
+    '''
+    The games of a history log since stats were last cleared, as columns:
+    time, deal, duration, moves and undos are arrays of integers, and
+    outcome is a bytearray of history.WON or LOST.
+
+    update reads only those records added since it was last called.
+    Results are cached until then.
+    '''
+
+    def __init__(self):
+        self.records = 0
+        self.clear()
+
+    def __len__(self):
+        return len(self.outcome)
+
+    def clear(self):
+        self.time = array('I')
+        self.deal = array('I')
+        self.duration = array('I')
+        self.moves = array('H')
+        self.undos = array('H')
+        self.outcome = bytearray()
+        self.cache = {}
+
+    def update(self, log):
+        '''
+        Adds the records appended to a history.HistoryLog since the last
+        update
+        '''
+        if len(log) < self.records:
+            # The log has been replaced; read it from the beginning
+            self.clear()
+            self.records = 0
+
+        for data in log.read_chunks(self.records):
+            self.extend(data)
+            self.records += len(data) // history.RECORD_SIZE
+
+    def extend(self, data):
+        '''
+        Adds records packed as in a history file
+        '''
+        size = history.RECORD_SIZE
+        outcome = data[16::size]
+
+        cleared = outcome.rfind(history.CLEARED)
+        if cleared != -1:
+            self.clear()
+            data = data[(cleared + 1) * size:]
+            outcome = outcome[cleared + 1:]
+
+        words = array('I', data)
+        halves = array('H', data)
+        if sys.byteorder == 'big':
+            words.byteswap()
+            halves.byteswap()
+
+        n = size // words.itemsize
+        self.time.extend(words[0::n])
+        self.deal.extend(words[1::n])
+        self.duration.extend(words[2::n])
+        n = size // halves.itemsize
+        self.moves.extend(halves[6::n])
+        self.undos.extend(halves[7::n])
+        self.outcome.extend(outcome)
+        self.cache.clear()
+
+    def append(self, rec):
+        '''
+        Adds a history.Record
+        '''
+        self.extend(rec.pack())
+
+    def cached(self, key, fn):
+        try:
+            return self.cache[key]
+        except KeyError:
+            value = self.cache[key] = fn()
+            return value
+
+    def sorted_times(self):
+        '''
+        Returns sorted arrays of the end times of all games and of games won
+        '''
+        # Records are appended in nearly sorted order, which sorts in
+        # linear time.
+        return self.cached('sorted_times', lambda: (
+            array('I', sorted(self.time)),
+            array('I', sorted(compress(self.time, self.outcome)))))
+
+    def win_time_counts(self):
+        '''
+        Returns a list of distinct durations of games won, in order,
+        and a list of the cumulative number of games won in each
+        '''
+        def counts():
+            counts = sorted(Counter(compress(self.duration, self.outcome))
+                .items())
+            return ([d for d, n in counts],
+                list(accumulate(n for d, n in counts)))
+        return self.cached('win_time_counts', counts)
+
+    def time_percentile(self, p):
+        '''
+        Returns the duration of games won at percentile p, by nearest rank,
+        or None if no games were won
+        '''
+        durations, totals = self.win_time_counts()
+        if not durations:
+            return None
+        rank = max(1, -(-totals[-1] * p // 100))
+        return durations[bisect_left(totals, rank)]
+
+    def streaks(self):
+        '''
+        Returns the Streaks of games
+        '''
+        def streaks():
+            outcome = self.outcome
+            won = len(outcome) - len(outcome.rstrip(_WON))
+            lost = len(outcome) - len(outcome.rstrip(_LOST))
+            return Streaks(won or -lost,
+                longest_run(outcome, _WON), longest_run(outcome, _LOST))
+        return self.cached('streaks', streaks)
+
+    def win_rates(self, period = 'day', utc_offset = None):
+        '''
+        Returns a list of (start, played, won) for each period in which
+        games were played, in order, where start is the time at which the
+        period began and period is one of PERIODS. Periods begin at midnight
+        of UTC plus utc_offset seconds; by default, the current offset of
+        local time.
+        '''
+        if utc_offset is None:
+            utc_offset = time.localtime().tm_gmtoff
+
+        def win_rates():
+            times, wins = self.sorted_times()
+            if not times:
+                return []
+
+            starts = list(period_starts(period, times[0], times[-1],
+                utc_offset))
+            # Index of the first game of each period, and of the first after
+            played = [bisect_left(times, t) for t in starts] + [len(times)]
+            won = [bisect_left(wins, t) for t in starts] + [len(wins)]
+
+            return [(t, played[i + 1] - played[i], won[i + 1] - won[i])
+                for i, t in enumerate(starts) if played[i + 1] != played[i]]
+        return self.cached(('win_rates', period, utc_offset), win_rates)
+
+    def period_win_rate(self, period, t = None, utc_offset = None):
+        '''
+        Returns (played, won) for the period containing time t,
+        by default the current time
+        '''
+        if t is None:
+            t = int(time.time())
+        if utc_offset is None:
+            utc_offset = time.localtime().tm_gmtoff
+
+        start = next(period_starts(period, t, t, utc_offset))
+        for s, played, won in reversed(self.win_rates(period, utc_offset)):
+            if s == start:
+                return played, won
+            if s < start:
+                break
+        return 0, 0
@@ -0,0 +1,268 @@
+#!/usr/bin/python3
+# -*- coding: utf-8
+
+import argparse
+from contextlib import closing
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from freecell import *
+import deal_index
+import solver
+
+__all__ = [
+    'build_index', 'main', 'parse_deals', 'solve_deal', 'solve_deals',
+]
+
+def parse_deals(s):
+    '''
+    Parses a deal specification such as "1-1000,2000,3000-3999"
+    and returns a list of ranges
+    '''
+    ranges = []
+
+    for part in s.split(','):
+        lo, sep, hi = part.strip().partition('-')
+        try:
+            lo = int(lo)
+            hi = int(hi) if sep else lo
+        except ValueError:
+            raise ValueError('invalid deal range: {!r}'.format(part))
+        if not 1 <= lo <= hi <= MAX_DEAL:
+            raise ValueError('invalid deal range: {!r}'.format(part))
+        ranges.append(range(lo, hi + 1))
+
+    return ranges
+
+def solve_deal(n, max_nodes = solver.DEFAULT_MAX_NODES,
+        max_time = solver.DEFAULT_MAX_TIME, cache = None):
+    '''
+    Solves the given deal number and returns a dict of results.
+    cache is an optional solver.PositionCache.
+    '''
+    r = solver.solve(FreeCell(deal(n)), max_nodes, max_time, cache)
+
+    if r.status == solver.UNKNOWN:
+        solvable = None
+    else:
+        solvable = r.solved
+
+    return {
+        'deal': n,
+        'solvable': solvable,
+        'moves': None if r.moves is None else len(r.moves),
+        'nodes': r.nodes,
+        'time': round(r.elapsed, 4),
+    }
+
+# Search budgets and position cache of worker processes;
+# set by _init_worker
+_budget = None
+_cache = None
+
+def _init_worker(max_nodes, max_time, cache_bytes):
+    global _budget, _cache
+    _budget = (max_nodes, max_time)
+    _cache = solver.PositionCache(cache_bytes) if cache_bytes else None
+
+def _solve_worker(n):
+    return solve_deal(n, *_budget, cache = _cache)
+
+def read_done(path):
+    '''
+    Returns the set of deal numbers recorded in a results file.
+    A partially written last line, left by an interrupted run, is ignored
+    and truncated so that new results may be appended.
+    '''
+    done = set()
+
+    try:
+        f = open(path, 'rb+')
+    except FileNotFoundError:
+        return done
+
+    with f:
+        good = 0
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                done.add(json.loads(line)['deal'])
+            except (ValueError, KeyError, TypeError):
+                break
+            good += len(line)
+        f.truncate(good)
+
+    return done
+
+# Result status by value of 'solvable' in solve_deal results
+STATUSES = { True: solver.SOLVED, False: solver.UNSOLVABLE,
+    None: solver.UNKNOWN }
+
+def solve_deals(deals, jobs, max_nodes, max_time,
+        cache_bytes = solver.DEFAULT_CACHE_BYTES):
+    '''
+    Solves each deal in the given iterable of deal numbers using jobs
+    processes, each caching positions in up to cache_bytes of memory.
+    Yields the result of solve_deal for each, in order of completion.
+    '''
+    if jobs == 1:
+        _init_worker(max_nodes, max_time, cache_bytes)
+        yield from map(_solve_worker, deals)
+        return
+
+    pool = multiprocessing.Pool(jobs, _init_worker,
+        (max_nodes, max_time, cache_bytes))
+    try:
+        yield from pool.imap_unordered(_solve_worker, deals, chunksize = 4)
+    finally:
+        pool.terminate()
+        pool.join()
+
+def run(deals, jobs, out, max_nodes, max_time, done = frozenset(),
+        cache_bytes = solver.DEFAULT_CACHE_BYTES):
+    '''
+    Solves each deal in the given iterable of deal numbers, except those
+    in done, writing each result to out as a line of JSON.
+    Returns a dict counting results by status.
+    '''
+    pending = (n for n in deals if n not in done)
+    counts = dict.fromkeys(STATUSES.values(), 0)
+
+    with closing(solve_deals(pending, jobs,
+            max_nodes, max_time, cache_bytes)) as results:
+        for res in results:
+            # Each line is flushed as it is written so that an interrupted
+            # run may be resumed without losing results.
+            out.write(json.dumps(res) + '\n')
+            out.flush()
+            counts[STATUSES[res['solvable']]] += 1
+
+    return counts
+
+def build_index(ranges, path, jobs, max_nodes, max_time,
+        cache_bytes = solver.DEFAULT_CACHE_BYTES):
+    '''
+    Solves the deals in the given list of ranges, recording the results
+    in the deal index file at path. If the file exists, it must cover all
+    of the deals, and those which it records are not solved again.
+    Returns a dict counting new results by status.
+    '''
+    first = min(r.start for r in ranges)
+    stop = max(r.stop for r in ranges)
+
+    if not os.path.exists(path):
+        deal_index.create_index(path, first, stop - first)
+
+    counts = dict.fromkeys(STATUSES.values(), 0)
+
+    with deal_index.DealIndex(path, writable = True) as index:
+        if first not in index or stop - 1 not in index:
+            raise ValueError('{} covers deals {}-{}'.format(path,
+                index.first, index.first + len(index) - 1))
+
+        # Records are written in place as results arrive, so that an
+        # interrupted build may be continued by running it again.
+        pending = (n for r in ranges for n in r if index.get(n) is None)
+
+        with closing(solve_deals(pending, jobs,
+                max_nodes, max_time, cache_bytes)) as results:
+            for res in results:
+                status = STATUSES[res['solvable']]
+                index.set(res['deal'], status, res['moves'])
+                counts[status] += 1
+
+        index.flush()
+
+    return counts
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = 'python -m freecell',
+        description = 'FreeCell batch tools')
+    commands = parser.add_subparsers(dest = 'command', metavar = 'command')
+    commands.required = True
+
+    # Options common to all commands
+    common = argparse.ArgumentParser(add_help = False)
+    common.add_argument('--deals', required = True, type = parse_deals,
+        help = 'deal numbers to solve, e.g. "1-1000,2000"')
+    common.add_argument('--jobs', '-j', type = int,
+        default = os.cpu_count() or 1,
+        help = 'number of worker processes (default: number of CPUs)')
+    common.add_argument('--max-nodes', type = int,
+        default = solver.DEFAULT_MAX_NODES,
+        help = 'maximum positions to expand per deal (default: %(default)s)')
+    common.add_argument('--max-time', type = float,
+        default = solver.DEFAULT_MAX_TIME,
+        help = 'maximum seconds to search per deal (default: %(default)s)')
+    common.add_argument('--cache-size', type = int, metavar = 'MB',
+        default = solver.DEFAULT_CACHE_BYTES >> 20,
+        help = 'position cache size of each worker, in megabytes; '
+            '0 disables the cache (default: %(default)s)')
+
+    p = commands.add_parser('solve', parents = [common],
+        help = 'solve a range of deals, writing results as JSON lines')
+    p.add_argument('--output', '-o', metavar = 'FILE',
+        help = 'write results to FILE instead of standard output, '
+            'replacing it unless --resume is given')
+    p.add_argument('--resume', action = 'store_true',
+        help = 'skip deals already recorded in the output file, '
+            'and append to it')
+
+    p = commands.add_parser('index', parents = [common],
+        help = 'solve a range of deals, recording results in a deal index')
+    p.add_argument('--output', '-o', metavar = 'FILE', required = True,
+        help = 'index file to create or continue')
+
+    args = parser.parse_args(argv)
+
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.cache_size < 0:
+        parser.error('--cache-size must not be negative')
+
+    start = time.perf_counter()
+
+    try:
+        if args.command == 'solve':
+            counts = solve_command(parser, args)
+        else:
+            counts = build_index(args.deals, args.output, args.jobs,
+                args.max_nodes, args.max_time, args.cache_size << 20)
+    except KeyboardInterrupt:
+        print('Interrupted', file = sys.stderr)
+        return 130
+    except (OSError, ValueError) as e:
+        print('{}: {}'.format(parser.prog, e), file = sys.stderr)
+        return 1
+
+    print('{} solved, {} unsolvable, {} unknown in {:.1f}s'.format(
+        counts[solver.SOLVED], counts[solver.UNSOLVABLE],
+        counts[solver.UNKNOWN], time.perf_counter() - start),
+        file = sys.stderr)
+    return 0
+
+def solve_command(parser, args):
+    if args.resume and not args.output:
+        parser.error('--resume requires --output')
+
+    done = read_done(args.output) if args.resume else frozenset()
+    deals = (n for r in args.deals for n in r)
+
+    if args.output:
+        out = open(args.output, 'a' if args.resume else 'w')
+    else:
+        out = sys.stdout
+
+    try:
+        return run(deals, args.jobs, out,
+            args.max_nodes, args.max_time, done, args.cache_size << 20)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
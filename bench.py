@@ -0,0 +1,402 @@
+#!/usr/bin/python3
+# -*- coding: utf-8
+
+'''
+Benchmarks of the FreeCell engine, solver, game drawing, and file I/O.
+
+Run all benchmarks, or those named, and report results as JSON:
+
+    python3 bench.py [--output FILE] [--compare OLD_FILE] [name ...]
+
+Every benchmark uses fixed deal numbers and random seeds, so that results
+of different versions may be compared.
+'''
+
+import argparse
+from contextlib import contextmanager
+import curses
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from freecell import *
+import replay
+import solver
+
+__all__ = [
+    'BENCHMARKS', 'main', 'run_benchmark',
+]
+
+# Deal numbers used by benchmarks
+DEALS = range(1, 33)
+SEED = 1
+
+# Each benchmark is registered under its name as a function which returns
+# (function, n): calling the function once performs n operations.
+BENCHMARKS = {}
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__[len('bench_'):]] = fn
+    return fn
+
+def positions(count = 8, depth = 20):
+    '''
+    Returns a list of positions reached by random play from fixed deals
+    '''
+    rng = random.Random(SEED)
+    result = []
+
+    for n in DEALS[:count]:
+        fc = FreeCell(deal(n))
+        fc.sweep()
+        for i in range(depth):
+            moves = list(fc.legal_moves())
+            if not moves:
+                break
+            fc.apply(rng.choice(moves))
+            fc.sweep()
+        result.append(fc)
+
+    return result
+
+@benchmark
+def bench_shuffle():
+    rng = random.Random(SEED)
+    def run():
+        for i in range(100):
+            deck = make_deck()
+            rng.shuffle(deck)
+            FreeCell(deck)
+    return run, 100
+
+@benchmark
+def bench_deal():
+    def run():
+        for n in DEALS:
+            FreeCell(deal(n))
+    return run, len(DEALS)
+
+@benchmark
+def bench_deal_array():
+    return (lambda: deal_array(1, 10001)), 10000
+
+@benchmark
+def bench_copy():
+    fcs = positions()
+    def run():
+        for fc in fcs:
+            fc.copy()
+    return run, len(fcs)
+
+@benchmark
+def bench_copy_persistent():
+    fcs = [PersistentFreeCell.from_key(fc.key()) for fc in positions()]
+    def run():
+        for fc in fcs:
+            fc.copy()
+    return run, len(fcs)
+
+@benchmark
+def bench_key():
+    fcs = positions()
+    def run():
+        for fc in fcs:
+            fc.key(True)
+    return run, len(fcs)
+
+@benchmark
+def bench_move_capacity():
+    fcs = positions()
+    pairs = [(fc, a, b) for fc in fcs
+        for a in range(fc.TABLEAU_SLOTS) if fc.tableau[a]
+        for b in range(fc.TABLEAU_SLOTS) if a != b]
+    def run():
+        for fc, a, b in pairs:
+            fc.move_capacity(a, b)
+            fc.count_group(a)
+    return run, len(pairs)
+
+@benchmark
+def bench_legal_moves():
+    fcs = positions()
+    def run():
+        for fc in fcs:
+            for m in fc.legal_moves():
+                pass
+    return run, len(fcs)
+
+@benchmark
+def bench_sweep():
+    # Fresh deals from which at least one card can be swept
+    fcs = []
+    for n in DEALS:
+        fc = FreeCell(deal(n))
+        if fc.sweep_step(1):
+            fcs.append(FreeCell(deal(n)))
+    def run():
+        for fc in fcs:
+            moves = []
+            fc.sweep(moves)
+            for m in reversed(moves):
+                fc.revert(m)
+    return run, len(fcs)
+
+def playout(keys, rng, max_moves = 100):
+    '''
+    Plays random moves from each position key; returns the number of moves
+    '''
+    total = 0
+    for key in keys:
+        fc = FreeCell.from_key(key)
+        fc.sweep()
+        for i in range(max_moves):
+            moves = list(fc.legal_moves())
+            if not moves:
+                break
+            fc.apply(rng.choice(moves))
+            fc.sweep()
+            total += 1
+    return total
+
+@benchmark
+def bench_playout():
+    '''Random games from fixed deals; operations are moves'''
+    keys = [FreeCell(deal(n)).key() for n in DEALS[:8]]
+    run = lambda: playout(keys, random.Random(SEED))
+    return run, run()
+
+@benchmark
+def bench_solve():
+    '''Solver on fixed deals; operations are positions expanded'''
+    fcs = [FreeCell(deal(n)) for n in DEALS[:4]]
+    nodes = sum(solver.solve(fc, None, None).nodes for fc in fcs)
+    def run():
+        for fc in fcs:
+            solver.solve(fc, None, None)
+    return run, nodes
+
+@benchmark
+def bench_replay():
+    '''Verification of solved game records; operations are records'''
+    records = []
+    for n in DEALS[:8]:
+        fc = FreeCell(deal(n))
+        moves = []
+        fc.sweep(moves)
+        for m in solver.solve(fc, None, None).moves:
+            fc.apply(m)
+            moves.append(m)
+            fc.sweep(moves)
+        records.append(replay.Record(n, 0, replay.encode_moves(moves)))
+    def run():
+        for r in records:
+            replay.verify(r)
+    return run, len(records)
+
+class FakeWindow(object):
+
+    '''A curses window which discards output'''
+
+    def __init__(self, y, x):
+        self.size = (y, x)
+
+    def getmaxyx(self):
+        return self.size
+
+    def addstr(self, *args):
+        pass
+
+    def clear(self):
+        pass
+
+    def noutrefresh(self):
+        pass
+
+@contextmanager
+def fake_curses(y = 30, x = 80):
+    '''
+    Replaces those curses functions which require a terminal, yielding
+    a fake standard screen of the given size
+    '''
+    saved = curses.newwin, curses.doupdate
+    curses.newwin = lambda h, w, top, left: FakeWindow(h, w)
+    curses.doupdate = lambda: None
+    try:
+        yield FakeWindow(y, x)
+    finally:
+        curses.newwin, curses.doupdate = saved
+
+def make_game(stdscr):
+    # Imported here, so that engine benchmarks do not depend on the game
+    from freecell_game import FreeCellGame
+    from game import Canvas, HeadlessBackend
+
+    # The screen is a Canvas, so that writing to the terminal is measured
+    game = FreeCellGame(HeadlessBackend(()))
+    game.start_game(DEALS[0])
+    game.skip_animation()
+    game.screen = Canvas(stdscr)
+    return game
+
+@benchmark
+def bench_draw():
+    '''Redrawing an unchanged field'''
+    with fake_curses() as stdscr:
+        game = make_game(stdscr)
+    def run():
+        with fake_curses():
+            for i in range(10):
+                game.draw()
+    return run, 10
+
+@benchmark
+def bench_draw_changed():
+    '''Drawing alternately before and after a move'''
+    with fake_curses() as stdscr:
+        game = make_game(stdscr)
+    fc = game.freecell
+    move = next(iter(fc.legal_moves()))
+    def run():
+        with fake_curses():
+            for i in range(5):
+                fc.apply(move)
+                game.board_changed()
+                game.draw()
+                fc.revert(move)
+                game.board_changed()
+                game.draw()
+    return run, 10
+
+@benchmark
+def bench_save_stats():
+    '''Recording a finished game in the history log and saving stats'''
+    from freecell_game import FreeCellGame, Stats
+    from game import HeadlessBackend
+    import history
+
+    # Removed when run is garbage collected
+    tmp = tempfile.TemporaryDirectory()
+    game = FreeCellGame.__new__(FreeCellGame)
+    game.backend = HeadlessBackend((), persist = True)
+    game.STATS_FILE = os.path.join(tmp.name, 'stats.cfg')
+    game.history = history.HistoryLog(os.path.join(tmp.name, 'history.dat'))
+    game.stats = Stats({})
+    rec = history.Record(0, DEALS[0], 100, 80, 0, history.WON)
+    def run(tmp = tmp):
+        for i in range(10):
+            game.add_history(rec)
+    return run, 10
+
+@benchmark
+def bench_history_stats():
+    '''Loading and analyzing game history; operations are games'''
+    import analytics
+    import history
+
+    rng = random.Random(SEED)
+    n = 100000
+    data = b''.join(history.Record(1 << 30 | i * 60, i, rng.randrange(60, 900),
+        rng.randrange(50, 200), rng.randrange(5), rng.random() < 0.6).pack()
+        for i in range(n))
+    def run():
+        columns = analytics.Columns()
+        columns.extend(data)
+        columns.time_percentile(50)
+        columns.time_percentile(90)
+        columns.streaks()
+        columns.win_rates('day', 0)
+        columns.win_rates('month', 0)
+    return run, n
+
+def run_benchmark(name, repeat = 5, min_time = 0.2):
+    '''
+    Runs the named benchmark and returns a dict of its results, in seconds
+    per operation. Each of repeat samples takes at least min_time seconds.
+    '''
+    fn, ops = BENCHMARKS[name]()
+
+    # Calibrate the number of calls per sample
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(number):
+            fn()
+        t = time.perf_counter() - start
+        if t >= min_time:
+            break
+        number *= 2 if t == 0 else max(2, min(10, int(min_time / t) + 1))
+
+    samples = [t]
+    for i in range(repeat - 1):
+        start = time.perf_counter()
+        for i in range(number):
+            fn()
+        samples.append(time.perf_counter() - start)
+
+    per_op = [s / (number * ops) for s in samples]
+    best = min(per_op)
+
+    return {
+        'ops': number * ops,
+        'best': best,
+        'median': statistics.median(per_op),
+        'ops_per_sec': 1 / best if best else None,
+    }
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = 'bench.py',
+        description = 'Run FreeCell benchmarks, reporting results as JSON')
+    parser.add_argument('names', nargs = '*', metavar = 'name',
+        help = 'benchmarks to run (default: all); one of: {}'.format(
+            ', '.join(BENCHMARKS)))
+    parser.add_argument('--repeat', '-r', type = int, default = 5,
+        help = 'number of samples of each benchmark (default: %(default)s)')
+    parser.add_argument('--output', '-o', metavar = 'FILE',
+        help = 'write results to FILE instead of standard output')
+    parser.add_argument('--compare', '-c', metavar = 'FILE',
+        help = 'print speed relative to results in FILE to standard error')
+
+    args = parser.parse_args(argv)
+
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: {}'.format(name))
+    if args.repeat < 1:
+        parser.error('--repeat must be at least 1')
+
+    old = None
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)['benchmarks']
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': int(time.time()),
+        'benchmarks': {},
+    }
+
+    for name in args.names or BENCHMARKS:
+        res = results['benchmarks'][name] = run_benchmark(name, args.repeat)
+
+        line = '{:<20} {:>12.3f} us/op'.format(name, res['best'] * 1e6)
+        if old is not None and name in old:
+            line += '  {:>6.2f}x'.format(old[name]['best'] / res['best'])
+        print(line, file = sys.stderr)
+
+    out = json.dumps(results, indent = 2) + '\n'
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out)
+    else:
+        sys.stdout.write(out)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+# -*- coding: utf-8
+
+import mmap
+import random
+import struct
+
+import solver
+
+__all__ = [
+    'DealIndex', 'create_index',
+]
+
+# File header: magic, version, first deal number, number of deals
+_HEADER = struct.Struct('<4sHxxII')
+_MAGIC = b'FCDI'
+_VERSION = 1
+
+# Record for each deal: status code and solution length
+_RECORD = struct.Struct('<BxH')
+
+# Status codes; zero marks a deal which has not been solved
+_STATUS_CODES = {
+    solver.SOLVED: 1,
+    solver.UNSOLVABLE: 2,
+    solver.UNKNOWN: 3,
+}
+_STATUSES = { v: k for k, v in _STATUS_CODES.items() }
+
+def create_index(path, first, count):
+    '''
+    Creates an index file for count deals, beginning with deal number first,
+    in which no deal has been solved
+    '''
+    with open(path, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, _VERSION, first, count))
+        f.truncate(_HEADER.size + count * _RECORD.size)
+
+class DealIndex(object):
+
+    '''
+    An index of solver results for a range of deal numbers, stored in a file
+    of fixed size records and accessed through mmap. Opening an index reads
+    only its header; records are paged in as they are used.
+    '''
+
+    # Random deals tried by choose before searching the whole index
+    CHOOSE_TRIES = 1000
+
+    def __init__(self, path, writable = False):
+        with open(path, 'r+b' if writable else 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0,
+                access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+
+        try:
+            magic, version, first, count = _HEADER.unpack_from(self.map)
+        except struct.error:
+            magic = version = None
+        if magic != _MAGIC or version != _VERSION or \
+                len(self.map) != _HEADER.size + count * _RECORD.size:
+            self.map.close()
+            raise ValueError('invalid deal index: {}'.format(path))
+
+        self.first = first
+        self.count = count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, n):
+        return self.first <= n < self.first + self.count
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.map.close()
+
+    def flush(self):
+        self.map.flush()
+
+    def _offset(self, n):
+        if n not in self:
+            raise IndexError('deal {} is not in index'.format(n))
+        return _HEADER.size + (n - self.first) * _RECORD.size
+
+    def get(self, n):
+        '''
+        Returns (status, moves) for deal number n, where status is one of
+        solver.SOLVED, UNSOLVABLE, or UNKNOWN, and moves is the length of
+        the solution found, or zero. Returns None if n has not been solved.
+        '''
+        code, moves = _RECORD.unpack_from(self.map, self._offset(n))
+        if code == 0:
+            return None
+        return _STATUSES[code], moves
+
+    def set(self, n, status, moves):
+        _RECORD.pack_into(self.map, self._offset(n),
+            _STATUS_CODES[status], min(moves or 0, 0xffff))
+
+    def choose(self, min_moves = None, max_moves = None, rng = random):
+        '''
+        Returns a deal number chosen uniformly from the solvable deals
+        whose solution length is within the given bounds, either of which
+        may be None; returns None if there are no such deals.
+        '''
+        code = _STATUS_CODES[solver.SOLVED]
+        lo = 0 if min_moves is None else min_moves
+        hi = 0xffff if max_moves is None else max_moves
+
+        # Rejection sampling is uniform and, unless few deals qualify,
+        # touches only a few pages of the index.
+        for _ in range(min(self.CHOOSE_TRIES, self.count)):
+            i = rng.randrange(self.count)
+            c, moves = _RECORD.unpack_from(self.map,
+                _HEADER.size + i * _RECORD.size)
+            if c == code and lo <= moves <= hi:
+                return self.first + i
+
+        records = _RECORD.iter_unpack(self.map[_HEADER.size:])
+        matches = [i for i, (c, moves) in enumerate(records)
+            if c == code and lo <= moves <= hi]
+
+        if not matches:
+            return None
+        return self.first + rng.choice(matches)
@@ -1,12 +1,16 @@
 #!/usr/bin/python3
 # -*- coding: utf-8
 
+from collections import namedtuple
+from functools import partial
 import itertools
 import random
 
 __all__ = [
-    'Card', 'FreeCell', 'InvalidMove', 'MoveFromEmpty',
-    'make_deck', 'shuffled',
+    'DECK', 'FOUNDATION', 'RESERVE', 'TABLEAU',
+    'Card', 'FreeCell', 'InvalidMove', 'Move', 'MoveFromEmpty',
+    'PersistentFreeCell',
+    'MAX_DEAL', 'deal', 'deal_array', 'make_deck', 'shuffled',
 ]
 
 class InvalidMove(Exception): pass
@@ -14,6 +18,17 @@ class MoveFromEmpty(Exception): pass
 
 class Card(object):
 
+    '''
+    Represents a playing card. There are exactly 52 Card instances;
+    Card(face, value) returns the interned instance for that card.
+    Cards are immutable and compare equal only to themselves.
+    '''
+
+    __slots__ = (
+        'face', 'value', 'index', 'face_index',
+        'color', 'color_bit', 'face_char', 'name',
+    )
+
     FACES = ('club', 'heart', 'spade', 'diamond')
     VALUES = range(1, 14)
 
@@ -38,42 +53,67 @@ class Card(object):
         13: 'K',
     }
 
-    def __init__(self, face, value):
-        assert face in self.FACES
-        assert value in self.VALUES
-        self.face = face
-        self.value = value
+    # Interned instances, keyed by (face, value); filled in below
+    _interned = {}
+
+    def __new__(cls, face, value):
+        try:
+            return cls._interned[face, value]
+        except (KeyError, TypeError):
+            raise ValueError('invalid card: {!r}, {!r}'.format(face, value))
+
+    @classmethod
+    def _make(cls, face, value):
+        c = object.__new__(cls)
+        face_index = cls.FACES.index(face)
+        color = cls.COLORS[face]
+        init = partial(object.__setattr__, c)
+        init('face', face)
+        init('value', value)
+        init('index', face_index * len(cls.VALUES) + value - 1)
+        init('face_index', face_index)
+        init('color', color)
+        init('color_bit', int(color == 'red'))
+        init('face_char', cls.FACE_CHARS[face])
+        init('name', cls.NAMES.get(value) or str(value))
+        cls._interned[face, value] = c
+        return c
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Card is immutable')
+
+    __delattr__ = __setattr__
 
     def __eq__(self, rhs):
         if isinstance(rhs, Card):
-            return self.face == rhs.face and self.value == rhs.value
+            return self is rhs
         return NotImplemented
 
+    def __hash__(self):
+        return self.index
+
+    def __reduce__(self):
+        return (Card, (self.face, self.value))
+
     def __repr__(self):
         return 'Card({!r}, {!r})'.format(self.face, self.value)
 
     def __str__(self):
         return '<Card {} {}>'.format(self.face_char, self.name)
 
-    @property
-    def color(self):
-        return self.COLORS[self.face]
-
-    @property
-    def face_char(self):
-        return self.FACE_CHARS[self.face]
-
     @classmethod
     def get_index(cls, face):
         return cls.FACES.index(face)
 
-    @property
-    def face_index(self):
-        return self.get_index(self.face)
+    @classmethod
+    def from_index(cls, i):
+        '''
+        Returns the Card with the given index, in the range 0 to 51
+        '''
+        return DECK[i]
 
-    @property
-    def name(self):
-        return self.NAMES.get(self.value) or str(self.value)
+# All 52 cards, ordered by index
+DECK = tuple(Card._make(*i) for i in itertools.product(Card.FACES, Card.VALUES))
 
 class stack(object):
 
@@ -112,96 +152,663 @@ class stack(object):
     def top(self):
         return self.li[-1]
 
+    def nth(self, n):
+        '''
+        Returns the nth item from the top; nth(1) is equivalent to top()
+        '''
+        return self.li[-n]
+
+class column(stack):
+
+    '''
+    A tableau stack which also tracks, for each card, the number of cards
+    in the valid group ending at that card
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.runs = []
+
+    def copy(self):
+        s = column.__new__(column)
+        s.li = self.li[:]
+        s.runs = self.runs[:]
+        return s
+
+    def group(self):
+        '''
+        Returns how many cards on top of the stack comprise a valid group
+        '''
+        runs = self.runs
+        return runs[-1] if runs else 0
+
+    def pop(self):
+        self.runs.pop()
+        return self.li.pop()
+
+    def push(self, item):
+        li = self.li
+        if li:
+            top = li[-1]
+            if item.color_bit != top.color_bit and item.value == top.value - 1:
+                self.runs.append(self.runs[-1] + 1)
+            else:
+                self.runs.append(1)
+        else:
+            self.runs.append(1)
+        li.append(item)
+
+class persistent_stack(object):
+
+    '''
+    A stack with the same interface as stack, stored as an immutable linked
+    list of (item, size, next) nodes. copy() is O(1) and copies share every
+    node; push and pop replace only the reference to the top node.
+    '''
+
+    __slots__ = ('head',)
+
+    def __init__(self):
+        self.head = None
+
+    def __bool__(self):
+        return self.head is not None
+
+    def __contains__(self, item):
+        return any(i == item for i in reversed(self))
+
+    def __iter__(self):
+        items = list(reversed(self))
+        items.reverse()
+        return iter(items)
+
+    def __len__(self):
+        head = self.head
+        return 0 if head is None else head[1]
+
+    def __reversed__(self):
+        node = self.head
+        while node is not None:
+            yield node[0]
+            node = node[2]
+
+    def copy(self):
+        s = self.__class__.__new__(self.__class__)
+        s.head = self.head
+        return s
+
+    def empty(self):
+        return self.head is None
+
+    def pop(self):
+        head = self.head
+        if head is None:
+            raise IndexError('pop from empty stack')
+        self.head = head[2]
+        return head[0]
+
+    def push(self, item):
+        head = self.head
+        self.head = (item, 1 if head is None else head[1] + 1, head)
+
+    def top(self):
+        head = self.head
+        if head is None:
+            raise IndexError('top of empty stack')
+        return head[0]
+
+    def nth(self, n):
+        '''
+        Returns the nth item from the top; nth(1) is equivalent to top()
+        '''
+        if not 1 <= n <= len(self):
+            raise IndexError('stack index out of range')
+        node = self.head
+        for _ in range(n - 1):
+            node = node[2]
+        return node[0]
+
+class persistent_column(persistent_stack):
+
+    '''
+    A persistent stack with the interface of column; each node additionally
+    records the number of cards in the valid group ending at its card
+    '''
+
+    __slots__ = ()
+
+    def group(self):
+        '''
+        Returns how many cards on top of the stack comprise a valid group
+        '''
+        head = self.head
+        return 0 if head is None else head[3]
+
+    def push(self, item):
+        head = self.head
+        if head is None:
+            self.head = (item, 1, None, 1)
+        else:
+            top = head[0]
+            if item.color_bit != top.color_bit and item.value == top.value - 1:
+                run = head[3] + 1
+            else:
+                run = 1
+            self.head = (item, head[1] + 1, head, run)
+
+RESERVE = 'reserve'
+FOUNDATION = 'foundation'
+TABLEAU = 'tableau'
+
+# Locations returned by FreeCell.locate, indexed by slot
+RESERVE_LOCATIONS = tuple((RESERVE, i) for i in range(4))
+FOUNDATION_LOCATIONS = tuple((FOUNDATION, i) for i in range(len(Card.FACES)))
+TABLEAU_LOCATIONS = tuple((TABLEAU, i) for i in range(8))
+
+# Encodings of each Card in FreeCell.key, by index
+CARD_CODES = tuple(bytes((c.index + 1,)) for c in DECK)
+
+class Move(namedtuple('Move', 'src src_index dest dest_index n')):
+
+    '''
+    Represents moving n cards from slot src_index of src to slot dest_index
+    of dest, where src and dest are one of RESERVE, FOUNDATION, or TABLEAU.
+    A move to foundation uses the face index of the card as dest_index.
+    '''
+
+    __slots__ = ()
+
 def make_deck():
-    return [Card(*i) for i in itertools.product(Card.FACES, Card.VALUES)]
+    return list(DECK)
 
 def shuffled(li):
     random.shuffle(li)
     return li
 
+# Highest deal number accepted by deal
+MAX_DEAL = 0x7fffffff
+
+# Microsoft deals number cards by value, then by suit in this order
+MS_FACES = ('club', 'diamond', 'heart', 'spade')
+
+# Maps Microsoft card numbers to Card indices; padded for bytes.translate
+_MS_INDEX = bytes(Card(MS_FACES[i % 4], i // 4 + 1).index
+    for i in range(52)).ljust(256, b'\0')
+
+def _check_deal(n):
+    if not 1 <= n <= MAX_DEAL:
+        raise ValueError('deal number out of range: {}'.format(n))
+
+def _ms_deal(seed):
+    '''
+    Returns the Microsoft deal for the given seed as a bytearray of
+    Microsoft card numbers, in the order they are dealt
+    '''
+    cards = bytearray(range(51, -1, -1))
+
+    for i in range(52):
+        seed = (seed * 214013 + 2531011) & 0x7fffffff
+        j = 51 - (seed >> 16) % (52 - i)
+        cards[i], cards[j] = cards[j], cards[i]
+
+    return cards
+
+def deal(n):
+    '''
+    Returns the deck for Microsoft FreeCell deal number n, ordered to be
+    passed to FreeCell. Deal numbers range from 1 to MAX_DEAL.
+    '''
+    _check_deal(n)
+    return [DECK[i] for i in _ms_deal(n).translate(_MS_INDEX)]
+
+# Number of deals generated at once by deal_array
+_DEAL_CHUNK = 1 << 15
+
+def deal_array(start, stop):
+    '''
+    Returns the decks for deal numbers in range(start, stop), as Card
+    indices ordered as for deal.
+
+    If NumPy is available, the result is a uint8 ndarray of shape
+    (stop - start, 52) and deals are generated in a vectorized manner.
+    Otherwise, an array.array of type 'B' is returned, containing 52
+    indices for each deal in turn.
+    '''
+    if stop > start:
+        _check_deal(start)
+        _check_deal(stop - 1)
+    else:
+        stop = start
+
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+
+    if numpy is None:
+        from array import array
+        decks = array('B')
+        for n in range(start, stop):
+            decks.frombytes(_ms_deal(n).translate(_MS_INDEX))
+        return decks
+
+    decks = numpy.empty((stop - start, 52), dtype = numpy.uint8)
+    ms_deck = numpy.arange(51, -1, -1, dtype = numpy.uint8)
+    ms_index = numpy.frombuffer(_MS_INDEX, dtype = numpy.uint8)
+
+    # Deals are generated in chunks small enough to stay in cache;
+    # within a chunk, each step of the shuffle is applied to every deal.
+    for lo in range(start, stop, _DEAL_CHUNK):
+        hi = min(stop, lo + _DEAL_CHUNK)
+        cards = decks[lo - start:hi - start]
+        cards[:] = ms_deck
+        flat = cards.reshape(-1)
+        base = numpy.arange(0, (hi - lo) * 52, 52, dtype = numpy.int64)
+        seeds = numpy.arange(lo, hi, dtype = numpy.int64)
+
+        for i in range(52):
+            seeds = (seeds * 214013 + 2531011) & 0x7fffffff
+            fi = base + i
+            fj = base + (51 - (seeds >> 16) % (52 - i))
+            tmp = flat[fi]
+            flat[fi] = flat[fj]
+            flat[fj] = tmp
+
+        cards[:] = ms_index[cards]
+
+    return decks
+
 class FreeCell(object):
 
     '''
     Represents a FreeCell game playing field and all possible operations
     '''
 
-    RESERVE_SLOTS = 4
-    FOUNDATION_SLOTS = len(Card.FACES)
-    TABLEAU_SLOTS = 8
+    RESERVE_SLOTS = len(RESERVE_LOCATIONS)
+    FOUNDATION_SLOTS = len(FOUNDATION_LOCATIONS)
+    TABLEAU_SLOTS = len(TABLEAU_LOCATIONS)
+
+    CLUB = Card.get_index('club')
+    HEART = Card.get_index('heart')
+    SPADE = Card.get_index('spade')
+    DIAMOND = Card.get_index('diamond')
+
+    # Highest values of (black, red) cards which may be swept to foundation,
+    # indexed by the lowest foundation heights of black and red suits.
+    # A card is safe to sweep if every card of the opposite color which
+    # could be placed on it can also be swept.
+    AUTO_LIMITS = tuple(
+        tuple((min(black + 3, red + 2), min(black + 2, red + 3))
+            for red in range(len(Card.VALUES) + 1))
+        for black in range(len(Card.VALUES) + 1))
+
+    # Stack types of foundation and tableau slots, respectively;
+    # see PersistentFreeCell
+    STACK = stack
+    COLUMN = column
 
     def __init__(self, deck):
         '''
         Initializes a FreeCell game; deck is expected to be shuffled
         '''
         self.reserve = [None] * self.RESERVE_SLOTS
-        self.foundation = [stack() for i in range(self.FOUNDATION_SLOTS)]
-        self.tableau = [stack() for i in range(self.TABLEAU_SLOTS)]
+        self.foundation = [self.STACK() for i in range(self.FOUNDATION_SLOTS)]
+        self.tableau = [self.COLUMN() for i in range(self.TABLEAU_SLOTS)]
+        # Number of empty reserve and tableau slots, respectively
+        self.free_cells = self.RESERVE_SLOTS
+        self.empty_columns = self.TABLEAU_SLOTS
+        # Location of each Card, by index; None if the Card is free
+        self.locations = [None] * len(DECK)
+        # Encoding of each tableau slot, as in key()
+        self.column_keys = [b''] * self.TABLEAU_SLOTS
         self.fill_tableau(deck)
 
     def copy(self):
-        fc = FreeCell.__new__(FreeCell)
+        fc = self.__class__.__new__(self.__class__)
         fc.reserve = self.reserve[:]
         fc.foundation = [s.copy() for s in self.foundation]
         fc.tableau = [t.copy() for t in self.tableau]
+        fc.free_cells = self.free_cells
+        fc.empty_columns = self.empty_columns
+        fc.locations = self.locations[:]
+        fc.column_keys = self.column_keys[:]
+        return fc
+
+    def key(self, canonical = False):
+        '''
+        Returns a compact bytes encoding of the playing field.
+
+        The key consists of the four foundation heights, the four reserve
+        slots and the tableau columns separated by zero bytes. Each card is
+        encoded as its index plus one; an empty reserve slot is zero.
+
+        If canonical is True, reserve slots and tableau columns are sorted,
+        so that positions differing only in slot order produce equal keys.
+        '''
+        reserve = [0 if c is None else c.index + 1 for c in self.reserve]
+        cols = self.column_keys
+
+        if canonical:
+            reserve.sort()
+            cols = sorted(cols)
+
+        return bytes(map(len, self.foundation)) + \
+            bytes(reserve) + b'\0'.join(cols)
+
+    @classmethod
+    def from_key(cls, key):
+        '''
+        Returns a FreeCell constructed from a key returned by key()
+        '''
+        nf = cls.FOUNDATION_SLOTS
+        nr = cls.RESERVE_SLOTS
+
+        cols = key[nf + nr:].split(b'\0')
+        if len(cols) != cls.TABLEAU_SLOTS:
+            raise ValueError('invalid FreeCell key')
+
+        fc = cls([])
+
+        for i, n in enumerate(key[:nf]):
+            for v in range(1, n + 1):
+                fc.push_foundation(Card(Card.FACES[i], v))
+
+        for i, n in enumerate(key[nf:nf + nr]):
+            if n:
+                fc.put_reserve(DECK[n - 1], i)
+
+        for i, col in enumerate(cols):
+            for n in col:
+                fc.push_tableau(DECK[n - 1], i)
+
         return fc
 
     def fill_tableau(self, deck):
-        slots = itertools.cycle(self.tableau)
+        slots = itertools.cycle(range(self.TABLEAU_SLOTS))
         for c in deck:
-            next(slots).push(c)
+            self.push_tableau(c, next(slots))
+
+    # Slots must only be modified through the following methods and
+    # move_from_reserve, which maintain free_cells, empty_columns,
+    # locations, and column_keys.
 
-    def sweep(self):
+    def push_tableau(self, c, i):
+        '''
+        Places Card c on tableau slot i without checking whether it is valid
+        '''
+        t = self.tableau[i]
+        if not t:
+            self.empty_columns -= 1
+        t.push(c)
+        self.locations[c.index] = TABLEAU_LOCATIONS[i]
+        self.column_keys[i] += CARD_CODES[c.index]
+
+    def pop_tableau(self, i):
+        '''
+        Removes and returns the top Card from tableau slot i
+        '''
+        t = self.tableau[i]
+        c = t.pop()
+        if not t:
+            self.empty_columns += 1
+        self.locations[c.index] = None
+        self.column_keys[i] = self.column_keys[i][:-1]
+        return c
+
+    def put_reserve(self, c, i):
+        '''
+        Places Card c in empty reserve slot i
+        '''
+        self.reserve[i] = c
+        self.free_cells -= 1
+        self.locations[c.index] = RESERVE_LOCATIONS[i]
+
+    def push_foundation(self, c):
+        '''
+        Places Card c on foundation without checking whether it is valid
+        '''
+        i = c.face_index
+        self.foundation[i].push(c)
+        self.locations[c.index] = FOUNDATION_LOCATIONS[i]
+
+    def pop_foundation(self, i):
+        '''
+        Removes and returns the top Card from foundation slot i
+        '''
+        c = self.foundation[i].pop()
+        self.locations[c.index] = None
+        return c
+
+    def sweep(self, moves = None):
         '''
         Sweeps every tableau and reserve slot and moves to foundation
         any card which meets the following conditions:
             It can be placed on foundation
             Any Card which may be placed on top may also be placed on foundation
         All slots are swept until no more cards can be moved
+
+        If moves is not None, each Move made is appended to it.
         '''
-        while 1:
+        self.sweep_step(len(DECK), moves)
+
+    def sweep_step(self, n = 1, moves = None):
+        '''
+        Attempts to sweep up to n cards and returns whether any were moved.
+        If moves is not None, each Move made is appended to it.
+        '''
+        # Only the next card of each suit can move to foundation, so rather
+        # than scanning every slot, these four cards are found by location.
+        foundation = self.foundation
+        locations = self.locations
+        tableau = self.tableau
+        num_values = len(Card.VALUES)
+        left = n
+
+        while True:
+            limits = self.AUTO_LIMITS[
+                min(len(foundation[self.SPADE]), len(foundation[self.CLUB]))][
+                min(len(foundation[self.HEART]), len(foundation[self.DIAMOND]))]
             moved = False
 
-            for i, r in enumerate(self.reserve):
-                if r is not None and self.should_move_to_foundation(r):
-                    self.move_to_foundation(self.move_from_reserve(i))
-                    moved = True
+            for s, f in enumerate(foundation):
+                h = len(f)
+                if h == num_values:
+                    continue
 
-            for t in self.tableau:
-                if t and self.should_move_to_foundation(t.top()):
-                    self.move_to_foundation(t.pop())
-                    moved = True
+                c = DECK[s * num_values + h]
+                if c.value > limits[c.color_bit]:
+                    continue
 
-            if not moved:
-                break
+                loc = locations[c.index]
+                if loc is None:
+                    continue
+                kind, i = loc
 
-    def sweep_step(self, n = 1):
-        '''
-        Attempts to sweep only one card and returns whether it was successful
-        '''
-        success = False
-        left = n
+                if kind == RESERVE:
+                    self.move_from_reserve(i)
+                elif tableau[i].top() is c:
+                    self.pop_tableau(i)
+                else:
+                    continue
 
-        for i, r in enumerate(self.reserve):
-            if r is not None and self.should_move_to_foundation(r):
-                self.move_to_foundation(self.move_from_reserve(i))
-                left -= 1
-                if left <= 0:
-                    return True
+                self.push_foundation(c)
+                if moves is not None:
+                    moves.append(Move(kind, i, FOUNDATION, s, 1))
 
-        for t in self.tableau:
-            if t and self.should_move_to_foundation(t.top()):
-                self.move_to_foundation(t.pop())
+                moved = True
                 left -= 1
                 if left <= 0:
                     return True
 
-        return left != n
+            if not moved:
+                return left != n
+
+    def apply(self, move):
+        '''
+        Performs the given Move, raising InvalidMove or MoveFromEmpty
+        if it is not legal. The field is unchanged if an exception is raised.
+
+        A group of n cards may be moved between tableau slots only if n is
+        at most move_capacity, which accounts for free reserve and tableau
+        slots as well as the length of the group.
+        '''
+        src, a, dest, b, n = move
+
+        if src == RESERVE:
+            c = self.reserve[a]
+            if c is None:
+                raise MoveFromEmpty
+            if n != 1:
+                raise InvalidMove
+            if dest == FOUNDATION:
+                if b != c.face_index or not self.can_move_to_foundation(c):
+                    raise InvalidMove
+                self.move_to_foundation(self.move_from_reserve(a))
+            elif dest == TABLEAU:
+                if not self.can_move_to_tableau(c, b):
+                    raise InvalidMove
+                self.move_to_tableau(self.move_from_reserve(a), b)
+            else:
+                raise InvalidMove
+        elif src == TABLEAU:
+            t = self.tableau[a]
+            if t.empty():
+                raise MoveFromEmpty
+            if dest == TABLEAU:
+                if a == b or not 0 < n <= self.move_capacity(a, b) or \
+                        not self.can_move_to_tableau(t.nth(n), b):
+                    raise InvalidMove
+                self.move_tableau_group(a, b, n)
+            elif n != 1:
+                raise InvalidMove
+            elif dest == FOUNDATION:
+                c = t.top()
+                if b != c.face_index or not self.can_move_to_foundation(c):
+                    raise InvalidMove
+                self.move_to_foundation(self.pop_tableau(a))
+            elif dest == RESERVE:
+                if self.reserve[b] is not None:
+                    raise InvalidMove
+                self.put_reserve(self.pop_tableau(a), b)
+            else:
+                raise InvalidMove
+        else:
+            raise InvalidMove
+
+    def revert(self, move):
+        '''
+        Reverses a Move previously performed by apply or sweep.
+        Moves must be reverted in the reverse order they were made.
+        '''
+        src, a, dest, b, n = move
+
+        if dest == RESERVE:
+            cards = [self.move_from_reserve(b)]
+        elif dest == FOUNDATION:
+            cards = [self.pop_foundation(b)]
+        else:
+            cards = [self.pop_tableau(b) for i in range(n)]
+
+        if src == RESERVE:
+            self.put_reserve(cards[0], a)
+        else:
+            for c in reversed(cards):
+                self.push_tableau(c, a)
+
+    def legal_moves(self, prev = None, distinct = False, partial = True):
+        '''
+        Yields every legal Move from the current position.
+
+        If prev is given, the Move which would undo it is omitted.
+
+        If distinct is True, moves which are equivalent to another move
+        up to the order of tableau slots are omitted: only the first empty
+        tableau slot is a destination and no move empties a tableau slot
+        into an empty slot.
+
+        If partial is False, a group is moved to an empty tableau slot only
+        as a whole, as many cards as move_capacity allows; otherwise, each
+        smaller number of cards is also a move.
+
+        The field must not be modified while iterating, except by applying
+        a yielded Move and reverting it before the next is requested.
+        '''
+        if prev is not None:
+            psrc, pa, pdest, pb, pn = prev
+            inverse = Move(pdest, pb, psrc, pa, pn)
+        else:
+            inverse = None
+
+        reserve = self.reserve
+        tableau = self.tableau
+        foundation = self.foundation
+
+        empty = [j for j, t in enumerate(tableau) if not t] \
+            if self.empty_columns else []
+        dests = empty[:1] if distinct else empty
+        tops = [(j, t.top()) for j, t in enumerate(tableau) if t]
+
+        for i, c in enumerate(reserve):
+            if c is None:
+                continue
+            if len(foundation[c.face_index]) == c.value - 1:
+                yield Move(RESERVE, i, FOUNDATION, c.face_index, 1)
+            for j, top in tops:
+                if c.color_bit != top.color_bit and c.value == top.value - 1:
+                    m = Move(RESERVE, i, TABLEAU, j, 1)
+                    if m != inverse:
+                        yield m
+            for j in dests:
+                m = Move(RESERVE, i, TABLEAU, j, 1)
+                if m != inverse:
+                    yield m
+
+        free = self.free_cells
+        free_slot = reserve.index(None) if free else None
+        # Maximum group sizes to a nonempty and to an empty tableau slot
+        cap_full = (1 + free) << len(empty)
+        cap_empty = cap_full >> 1
+
+        for i, c in tops:
+            t = tableau[i]
+
+            if len(foundation[c.face_index]) == c.value - 1:
+                yield Move(TABLEAU, i, FOUNDATION, c.face_index, 1)
+
+            group = t.group()
+
+            for j, top in tops:
+                # Only one group size can be placed on a given card
+                n = top.value - c.value
+                if 0 < n <= group and n <= cap_full and \
+                        t.nth(n).color_bit != top.color_bit:
+                    m = Move(TABLEAU, i, TABLEAU, j, n)
+                    if m != inverse:
+                        yield m
+
+            if dests:
+                n = min(group, cap_empty)
+                if distinct and n == len(t):
+                    n -= 1
+                    sizes = range(n, 0, -1) if partial else ()
+                else:
+                    sizes = range(n, 0, -1) if partial else (n,)
+                for j in dests:
+                    for k in sizes:
+                        m = Move(TABLEAU, i, TABLEAU, j, k)
+                        if m != inverse:
+                            yield m
+
+            if free:
+                m = Move(TABLEAU, i, RESERVE, free_slot, 1)
+                if m != inverse:
+                    yield m
 
     def can_top(self, a, b):
         '''
         Returns whether Card a can be placed, on the tableau, on top of Card b
         '''
-        return a.color != b.color and a.value == b.value - 1
+        return a.color_bit != b.color_bit and a.value == b.value - 1
 
     def can_move_to_tableau(self, c, i):
         '''
@@ -214,8 +821,8 @@ class FreeCell(object):
         '''
         Returns whether the given Card can be moved to foundation
         '''
-        f = self.foundation[c.face_index]
-        return c.value == 1 if f.empty() else (f.top().value == c.value - 1)
+        # Foundation slots are built up from the ace, so height equals value
+        return len(self.foundation[c.face_index]) == c.value - 1
 
     def should_move_to_foundation(self, c):
         '''
@@ -225,34 +832,26 @@ class FreeCell(object):
         if not self.can_move_to_foundation(c):
             return False
 
-        def get_value(idx):
-            f = self.foundation[idx]
-            return 0 if f.empty() else f.top().value
-
-        min_black = min(
-            get_value(Card.get_index('spade')),
-            get_value(Card.get_index('club')))
-
-        min_red = min(
-            get_value(Card.get_index('heart')),
-            get_value(Card.get_index('diamond')))
-
-        if c.color == 'black':
-            auto_black = min(min_black + 3, min_red + 2)
-            return c.value <= auto_black
-        else:
-            auto_red = min(min_black + 2, min_red + 3)
-            return c.value <= auto_red
+        f = self.foundation
+        limits = self.AUTO_LIMITS[
+            min(len(f[self.SPADE]), len(f[self.CLUB]))][
+            min(len(f[self.HEART]), len(f[self.DIAMOND]))]
+        return c.value <= limits[c.color_bit]
 
     def is_free(self, c):
         '''
         Returns whether the Card has been freed; that is, the Card is not
         contained in either reserve, foundation, or tableau
         '''
-        assert isinstance(c, Card)
-        return c not in self.reserve and \
-            all(c not in f for f in self.foundation) and \
-            all(c not in t for t in self.tableau)
+        return self.locations[c.index] is None
+
+    def locate(self, c):
+        '''
+        Returns the location of the Card as a tuple (slot type, slot index),
+        where slot type is one of RESERVE, FOUNDATION, or TABLEAU.
+        Returns None if the Card is free.
+        '''
+        return self.locations[c.index]
 
     def move_capacity(self, a, b):
         '''
@@ -264,43 +863,24 @@ class FreeCell(object):
         NOTE: This method does NOT check whether such a move is valid
         based on the card on top of slot b.
         '''
-        if self.tableau[a].empty():
+        tableau = self.tableau
+        if not tableau[a]:
             raise MoveFromEmpty
-        to_empty = (self.tableau[b].empty())
-        empty_slots = sum(1 for t in self.tableau if t.empty())
-        return min(self.count_group(a),
-            (1 + self.reserve.count(None)) * 2 ** (empty_slots - to_empty))
+        to_empty = not tableau[b]
+        return min(tableau[a].group(),
+            (1 + self.free_cells) << (self.empty_columns - to_empty))
 
     def count_group(self, i):
         '''
         Returns how many cards on top of slot i comprise a valid group
         '''
-        t = self.tableau[i]
-        if t.empty():
-            return 0
-        if len(t) == 1:
-            return 1
-
-        n = 1
-
-        # From top of stack, iterate over adjacent pairs
-        r = reversed(t)
-        r2 = reversed(t)
-        next(r2)
-
-        for a, b in zip(r, r2):
-            if self.can_top(a, b):
-                n += 1
-            else:
-                break
-
-        return n
+        return self.tableau[i].group()
 
     def move_to_foundation(self, c):
         if not self.can_move_to_foundation(c):
             raise InvalidMove
 
-        self.foundation[c.face_index].push(c)
+        self.push_foundation(c)
 
     def move_to_tableau(self, c, i):
         '''
@@ -311,7 +891,7 @@ class FreeCell(object):
         if not self.can_move_to_tableau(c, i):
             raise InvalidMove
 
-        self.tableau[i].push(c)
+        self.push_tableau(c, i)
 
     def move_tableau_group(self, a, b, n):
         '''
@@ -322,9 +902,7 @@ class FreeCell(object):
         if n > self.move_capacity(a, b):
             raise InvalidMove
 
-        ta = self.tableau[a]
-
-        cards = [ta.pop() for i in range(n)]
+        cards = [self.pop_tableau(a) for i in range(n)]
         [self.move_to_tableau(c, b) for c in reversed(cards)]
 
     def move_to_reserve(self, c):
@@ -333,7 +911,7 @@ class FreeCell(object):
         if not self.reserve_free():
             raise InvalidMove
 
-        self.reserve[self.reserve.index(None)] = c
+        self.put_reserve(c, self.reserve.index(None))
 
     def move_from_reserve(self, i):
         if self.reserve[i] is None:
@@ -341,10 +919,34 @@ class FreeCell(object):
 
         c = self.reserve[i]
         self.reserve[i] = None
+        self.free_cells += 1
+        self.locations[c.index] = None
         return c
 
     def reserve_free(self):
-        return not all(self.reserve)
+        return self.free_cells != 0
 
     def won(self):
-        return all(t.empty() for t in self.tableau)
+        return self.empty_columns == self.TABLEAU_SLOTS
+
+class PersistentFreeCell(FreeCell):
+
+    '''
+    A FreeCell whose foundation and tableau slots are persistent stacks.
+
+    copy() shares every card of the copied slots, costing only the reserve
+    and location tables, so that snapshots of many related positions,
+    as in a search tree, take memory in proportion to the moves between
+    them rather than to the size of the board. Operations which look
+    below the top of a slot, such as iteration, are somewhat slower.
+    '''
+
+    STACK = persistent_stack
+    COLUMN = persistent_column
+
+if __name__ == '__main__':
+    # Command line tools live in a separate module, so that FreeCell classes
+    # are imported from the freecell module rather than defined in __main__.
+    import sys
+    from batch import main
+    sys.exit(main())
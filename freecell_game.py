@@ -6,20 +6,35 @@ from functools import partial
 import itertools
 import json
 import os
+import random
 import sys
 import time
 
+from deal_index import DealIndex
 from freecell import *
 from game import *
+import history
+import replay
+import savegame
+import solver
 
 class Stats(object):
 
+    '''
+    Totals of games in the history log. cfg is a saved copy of the totals
+    of the first cfg['history'] records, from which reading continues.
+    Totals saved before there was a history log count until stats are
+    first cleared.
+    '''
+
     def __init__(self, cfg):
         self.games_played = cfg.get('games', 0)
         self.games_won = cfg.get('won', 0)
         self.total_time = cfg.get('total_time', 0)
         self.lowest_time = cfg.get('lowest_time', 0)
         self.highest_time = cfg.get('highest_time', 0)
+        # Number of history records counted
+        self.records = cfg.get('history', 0)
 
     def add_game(self):
         self.games_played += 1
@@ -43,6 +58,29 @@ class Stats(object):
             return 0
         return self.games_won * 100 // self.games_played
 
+    def add_record(self, rec):
+        '''Counts a history.Record'''
+        if rec.outcome == history.CLEARED:
+            self.clear()
+        elif rec.outcome == history.WON:
+            self.add_game_won(rec.duration)
+        else:
+            self.add_game()
+
+    def update(self, log):
+        '''
+        Counts the records added to a history.HistoryLog, possibly by
+        other sessions, since the last update
+        '''
+        if len(log) < self.records:
+            # The log has been replaced; count it from the beginning
+            self.clear()
+            self.records = 0
+
+        for rec in log.read(self.records):
+            self.add_record(rec)
+            self.records += 1
+
     def clear(self):
         self.games_played = 0
         self.games_won = 0
@@ -57,32 +95,92 @@ class Stats(object):
             'total_time': self.total_time,
             'lowest_time': self.lowest_time,
             'highest_time': self.highest_time,
+            'history': self.records,
         }
 
 class FreeCellGame(Game):
 
     GAME_TITLE = 'FreeCell'
+    # Totals of HISTORY_FILE, saved so that it need not be read in full
     STATS_FILE = '~/.config/mur-freecell/stats.cfg'
-
-    def __init__(self, stdscr):
-        super().__init__(stdscr)
+    HISTORY_FILE = '~/.config/mur-freecell/history.dat'
+    # Games in progress when the player quit, one file each
+    SAVE_DIR = '~/.config/mur-freecell/saved'
+    OPTIONS_FILE = '~/.config/mur-freecell/options.cfg'
+    RECORDS_FILE = '~/.config/mur-freecell/games.rec'
+    # Built with: python3 -m freecell index --deals 1-1000000 -o FILE
+    DEAL_INDEX_FILE = '~/.config/mur-freecell/deals.idx'
+
+    # New games are chosen from deal numbers 1 through NUM_DEALS
+    NUM_DEALS = 1000000
+
+    # Deals which new games may use: name, followed by bounds of solution
+    # length in the deal index, or None to choose any deal
+    DEAL_FILTERS = [
+        ('any', None),
+        ('solvable', (None, None)),
+        ('easy', (None, 70)),
+        ('hard', (90, None)),
+    ]
+
+    # Keys referencing tableau slots and, after R, reserve slots
+    SLOT_KEYS = 'ASDFGHJK'
+
+    # Seconds of hint search performed when a hint is requested, and then
+    # on each pass of the main loop until the search is complete
+    HINT_FIRST_SLICE = 0.03
+    HINT_SLICE = 0.01
+    # Positions searched before a hint search gives up
+    HINT_MAX_NODES = 50000
+
+    # Cards swept to foundation per second; a whole deck takes under a second
+    SWEEP_RATE = 90
+
+    def __init__(self, backend):
+        super().__init__(backend)
         self.action_display = []
         self.action_input = []
         self.action_keys = set()
+        self.deal_number = None
+        # Opened when first needed; False if it could not be opened
+        self.deal_index = None
         self.freecell = None
+        self.history = history.HistoryLog(
+            os.path.expanduser(self.HISTORY_FILE))
+        # Columns of history, read when the stats screen is first shown,
+        # and the figures last computed from them, or None
+        self.history_columns = None
+        self.stats_report = None
+        # Bitmask of highlighted card indices, updated by update_highlight
+        self.highlight_mask = 0
+        # Current hint search and the message it last displayed
+        self.hint_search = None
+        self.hint_message = None
+        # Whether to search again once the field settles after a change
+        self.hint_restart = False
+        # Results of hint searches, reused after undo and redo
+        self.position_cache = solver.PositionCache()
         self.locate_match = None
+        self.options = self.load_config(self.OPTIONS_FILE)
         self.stats = Stats(self.load_config(self.STATS_FILE))
-        self.try_sweep = False
+        self.update_stats()
+        # Moves made by sweeping before the first player move
+        self.start_moves = []
         self.undo_list = []
         self.undo_index = None
+        # Number of undos in the current game
+        self.undo_count = 0
 
         self.key_callbacks = {
             ord(' '): self.clear_action,
             ctrl('['): self.clear_action,
+            ord('i'): self.hint,
             ord('l'): self.begin_locate,
+            ord('D'): self.next_deal_filter,
             ctrl('l'): self.redraw,
             ord('n'): self.confirm_new_game,
             ord('p'): self.toggle_pause,
+            ord('.'): self.skip_animation,
             ord('q'): self.confirm_quit_game,
             ctrl('r'): self.redo,
             ord('S'): self.show_stats,
@@ -107,9 +205,34 @@ class FreeCellGame(Game):
             ord('f'), ord('g'), ord('h'), ord('j'), ord('k'),
         }
 
+    def before_tick(self):
+        super().before_tick()
+        if self.hint_restart and not (self.animating or self.paused):
+            self.hint()
+        if self.hint_running():
+            self.run_hint(self.HINT_SLICE)
+        # The stats screen is drawn before history is read, so that it
+        # appears at once
+        if self.stats_loading() and not self.queue_redraw:
+            self.load_stats_report()
+
+    def next_deadline(self):
+        if self.hint_running() or self.stats_loading() or \
+                (self.hint_restart and not (self.animating or self.paused)):
+            # Continue as soon as pending input is handled
+            return time.time()
+        return super().next_deadline()
+
     def init_colors(self):
         super().init_colors()
-        curses.init_pair(1, curses.COLOR_RED, -1)
+        self.backend.init_pair(1, curses.COLOR_RED, -1)
+
+    def draw_title(self, y, x):
+        '''Draws the title and deal number to the screen'''
+        super().draw_title(y, x)
+        if self.deal_number is not None:
+            self.screen.addstr(0, len(self.GAME_TITLE) + 2,
+                '#{}'.format(self.deal_number), curses.A_REVERSE)
 
     def repr_card(self, c):
         '''
@@ -117,22 +240,22 @@ class FreeCellGame(Game):
         '''
         attr = 0
         if c.color == 'red':
-            attr = curses.color_pair(1)
+            attr = self.backend.color_pair(1)
         if self.highlight(c):
             attr |= curses.A_REVERSE
         return '{} {:>2}'.format(c.face_char, c.name), attr
 
-    def repr_stack(self, s):
+    def repr_foundation(self, i):
         '''
-        Returns a two-tuple (card string, curses attr) for a stack of cards.
+        Returns a two-tuple (card string, curses attr) for a foundation slot.
         The top card is rendered normally, but highlighting is applied if
-        any cards in the stack match.
+        any cards in the slot match.
         '''
         attr = 0
-        c = s.top()
+        c = self.freecell.foundation[i].top()
         if c.color == 'red':
-            attr = curses.color_pair(1)
-        if any(self.highlight(i) for i in s):
+            attr = self.backend.color_pair(1)
+        if self.highlight_foundation(i):
             attr |= curses.A_REVERSE
         return '{} {:>2}'.format(c.face_char, c.name), attr
 
@@ -141,7 +264,7 @@ class FreeCellGame(Game):
         Draws playing field containing cards and slots
         '''
         fc = self.freecell
-        win = self.stdscr
+        win = self.screen
 
         # draw_centered would be easier, but this line contains attributes
         win.move(2, (x - ((4 * 5 + 5) * 2 + 1)) // 2)
@@ -162,11 +285,11 @@ class FreeCellGame(Game):
 
         win.addstr('] [ ')
 
-        for f in fc.foundation:
+        for i, f in enumerate(fc.foundation):
             if f.empty():
                 win.addstr('____')
             else:
-                win.addstr(*self.repr_stack(f))
+                win.addstr(*self.repr_foundation(i))
             win.addstr(' ')
 
         win.addstr('] T')
@@ -176,8 +299,7 @@ class FreeCellGame(Game):
         #           ` Eight slots
 
         win.addstr(4, off,
-            '  '.join(' {}  '.format(k)
-                for k in ('A', 'S', 'D', 'F', 'G', 'H', 'J', 'K')),
+            '  '.join(' {}  '.format(k) for k in self.SLOT_KEYS),
                 curses.A_UNDERLINE)
 
         r = itertools.repeat(None)
@@ -196,7 +318,7 @@ class FreeCellGame(Game):
 
     def draw_message(self, y, x):
         '''Draws message and action input'''
-        win = self.stdscr
+        win = self.screen
         if self.action_display:
             action = self.action_display
             ln = sum(len(i) for i in action) + len(action)
@@ -213,6 +335,7 @@ class FreeCellGame(Game):
             'N            Start a new game',
             'P            Pause or unpause the game',
             'S            Show game stats',
+            'Shift-D      Choose deals for new games',
             '',
             'L            Start card lookup (Esc or Space to end)',
             'R or B       Search for a Red or Black card',
@@ -220,15 +343,14 @@ class FreeCellGame(Game):
             'L again      Search for lowest cards in play',
             '',
             'Esc or Space Cancel an action',
-            'U            Undo an action',
-            'Ctrl-R       Redo an action',
-            'A-K          Reference a slot on the tableau',
+            'U or Ctrl-R  Undo or redo an action',
+            'I            Suggest a move',
+            '.            Finish moving cards to foundation',
+            'A-K          Reference a slot on the tableau (twice: to reserve)',
             'R, then A-F  Reference a slot on the reserve',
             'T            Reference the foundation',
             '',
-            'To move a card, reference the source slot,',
-            '  then the destination slot.',
-            'Pressing tableau key twice moves to reserve.',
+            'To move a card, reference the source slot, then the destination.',
         ]
 
         starty = max(1, (y - (len(lines) + 2)) // 2)
@@ -242,15 +364,38 @@ class FreeCellGame(Game):
     def draw_stats(self, y, x):
         '''Draws stats screen'''
         stats = self.stats
+        report = self.stats_report
+
+        def value(key, fmt = str):
+            if report is None:
+                return '...'
+            if report[key] is None:
+                return '-'
+            return fmt(report[key])
+
+        def rate(played_won):
+            played, won = played_won
+            return '{}%'.format(won * 100 // played) if played else '-'
+
+        def streak(n):
+            return '{} {}'.format(abs(n), 'won' if n > 0 else 'lost') \
+                if n else '-'
 
         lines = [
             'Games played: {:>5}'.format(stats.games_played),
             'Games won:    {:>5}'.format(stats.games_won),
             'Win rate:     {:>4}%'.format(stats.get_win_rate()),
+            'This week:    {:>5}'.format(value('week', rate)),
+            'This month:   {:>5}'.format(value('month', rate)),
             '',
             'Average time: {:>5}'.format(time_str(stats.get_average_time())),
+            'Median time:  {:>5}'.format(value('median', time_str)),
+            '90% of wins:  {:>5}'.format(value('p90', time_str)),
             'Lowest time:  {:>5}'.format(time_str(stats.lowest_time)),
             'Highest time: {:>5}'.format(time_str(stats.highest_time)),
+            '',
+            'Streak:       {:>5}'.format(value('streak', streak)),
+            'Best streak:  {:>5}'.format(value('best_streak')),
         ]
 
         starty = (y - (len(lines) + 4)) // 2
@@ -262,41 +407,103 @@ class FreeCellGame(Game):
 
         self.draw_centered(starty + len(lines) + 3, x, "Press 'c' to clear")
 
-    def before_tick(self):
-        super().before_tick()
-        if not self.paused and self.try_sweep:
-            self.sweep_step()
+    def animate(self):
+        '''Sweeps SWEEP_RATE / ANIMATION_FPS cards to foundation per frame'''
+        return self.sweep_step(max(1, self.SWEEP_RATE // self.ANIMATION_FPS))
+
+    def finish_animation(self):
+        '''Sweeps all remaining cards at once'''
+        self.sweep_step(len(DECK))
 
     def end_game(self):
         if not self.stopped and self.undo_list:
-            self.stats.add_game()
-            self.save_stats()
+            self.save_game()
+
+    def game_time(self):
+        '''Returns the time, in seconds, spent playing the current game'''
+        now = self.pause_time if self.paused else time.time()
+        return int(now - self.time_offset)
+
+    def save_game(self):
+        '''
+        Saves the current game to be resumed when the game is next launched.
+        If it cannot be saved, the game is counted as lost.
+        '''
+        if self.backend.persist:
+            saved = savegame.SavedGame(self.deal_number, self.game_time(),
+                self.undo_count, self.start_moves, self.undo_list,
+                self.undo_index)
+            try:
+                savegame.save(os.path.expanduser(self.SAVE_DIR), saved)
+                return
+            except (OSError, ValueError):
+                pass
+
+        self.record_game(history.LOST, self.game_time())
+
+    def resume_game(self):
+        if not self.backend.persist:
+            return False
+
+        saved = None
+        try:
+            saved = savegame.load_latest(os.path.expanduser(self.SAVE_DIR))
+            if saved is None:
+                return False
+            self.start_game(saved.deal)
+            self.start_moves, self.undo_list = \
+                savegame.restore(self.freecell, saved)
+        except (OSError, ValueError) as e:
+            if saved is not None:
+                # The save file is already removed, and the game cannot be
+                # continued, so it is counted as lost. Its moves are not
+                # added to RECORDS_FILE, since they could not be replayed.
+                moves = len(saved.undo_list[:saved.undo_index])
+                self.add_history(history.Record(int(time.time()),
+                    saved.deal, saved.time, moves, saved.undos,
+                    history.LOST))
+            self.set_message('Failed to resume game: {}'.format(e), 3)
+            if self.freecell is None:
+                return False
+            # Begin the deal afresh rather than a partly restored game
+            self.start_game(self.deal_number)
+            return True
+
+        self.undo_index = saved.undo_index
+        self.undo_count = saved.undos
+        self.time_offset = time.time() - saved.time
+        if self.undo_index is not None:
+            self.stop_animation()
+        self.board_changed()
+        self.set_message('Resumed saved game', 3)
+        return True
 
     def game_won(self):
         '''Called when the game has been won'''
         self.paused = False
         self.stopped = True
-        self.try_sweep = False
-        win_time = int(time.time() - self.time_offset)
+        self.stop_animation()
+        win_time = self.game_time()
         self.clear_action()
         self.clear_grab()
         self.clear_message()
         self.grab_input(self.stopped_callback)
         self.queue_redraw = True
 
-        self.stats.add_game_won(win_time)
-        self.save_stats()
+        self.record_game(history.WON, win_time)
 
     def begin_locate(self):
         self.clear_action()
         self.action_display[:] = ['L', '*', '?']
         self.locate_match = { 'color': None, 'value': None }
+        self.update_highlight()
         self.grab_input(self.locate_callback)
 
     def locate_callback(self, ch):
         if ch == ord(' ') or ch == ctrl('['):
             self.clear_action()
             self.locate_match = None
+            self.update_highlight()
             return False
         elif ch == ord('b'):
             self.locate_match['color'] = 'black'
@@ -329,25 +536,70 @@ class FreeCellGame(Game):
         else:
             return True
 
+        self.update_highlight()
         self.queue_redraw = True
         return True
 
     def highlight(self, c):
         '''Returns whether the given card should be highlighted'''
-        m = self.locate_match
-        if m is not None:
+        return self.highlight_mask >> c.index & 1
+
+    def highlight_foundation(self, i):
+        '''
+        Returns whether any card in the given foundation slot should be
+        highlighted
+        '''
+        f = self.freecell.foundation[i]
+        # Cards in a foundation slot have consecutive indices up to the top
+        n = len(f)
+        return self.highlight_mask >> (f.top().index + 1 - n) & ((1 << n) - 1)
+
+    def update_highlight(self):
+        '''
+        Recomputes highlight_mask after locate_match or the field changes,
+        queueing a redraw only if the highlighted cards have changed
+        '''
+        mask = 0
+        for c in self.locate_cards():
+            mask |= 1 << c.index
+
+        if mask != self.highlight_mask:
+            self.highlight_mask = mask
             self.queue_redraw = True
-            return self.color_matches(c, m['color']) and \
-                self.value_matches(c, m['value'])
-        return False
 
-    def color_matches(self, c, color):
-        return color is None or c.color == color
+    def board_changed(self):
+        '''
+        Called when cards have moved on the field
+        '''
+        self.queue_redraw = True
+        self.update_highlight()
+
+    def locate_cards(self):
+        '''
+        Returns the set of cards in play which match locate_match
+        '''
+        m = self.locate_match
+        if m is None:
+            return frozenset()
+
+        fc = self.freecell
+        color = m['color']
+        value = m['value']
+
+        faces = [f for f in Card.FACES
+            if color is None or Card.COLORS[f] == color]
 
-    def value_matches(self, c, value):
         if value == 'low':
-            return self.freecell.can_move_to_foundation(c)
-        return c.value == value
+            # Lowest cards are those which can be moved to foundation
+            heights = [len(fc.foundation[Card.get_index(f)]) for f in faces]
+            cards = [Card(f, h + 1) for f, h in zip(faces, heights)
+                if h < len(Card.VALUES)]
+        elif value is None:
+            cards = [Card(f, v) for f in faces for v in Card.VALUES]
+        else:
+            cards = [Card(f, value) for f in faces]
+
+        return frozenset(c for c in cards if fc.locate(c) is not None)
 
     def clear_action(self):
         del self.action_input[:]
@@ -360,13 +612,10 @@ class FreeCellGame(Game):
         self.action_display.append(text)
         self.queue_redraw = True
 
-        state = self.copy_state()
-
         handled, acted = self.handle_action()
 
         if acted:
-            self.try_sweep = True
-            self.push_undo(state)
+            self.start_animation()
             return False
         elif handled:
             return False
@@ -412,14 +661,15 @@ class FreeCellGame(Game):
                                 self.set_message('Cannot move to foundation')
                             else:
                                 acted = handled = True
-                                fc.move_to_foundation(fc.move_from_reserve(res_n))
+                                self.play(Move(RESERVE, res_n, FOUNDATION,
+                                    fc.reserve[res_n].face_index, 1))
                         elif isinstance(act[2], int):
                             if not fc.can_move_to_tableau(fc.reserve[res_n], act[2]):
                                 handled = True
                                 self.set_message('Cannot move to tableau')
                             else:
                                 acted = handled = True
-                                fc.move_to_tableau(fc.move_from_reserve(res_n), act[2])
+                                self.play(Move(RESERVE, res_n, TABLEAU, act[2], 1))
                         else:
                             handled = True
                             self.set_message('Invalid action')
@@ -444,14 +694,16 @@ class FreeCellGame(Game):
                         self.set_message('No free reserve slots')
                     else:
                         acted = handled = True
-                        fc.move_to_reserve(fc.tableau[tab_n].pop())
+                        self.play(Move(TABLEAU, tab_n, RESERVE,
+                            fc.reserve.index(None), 1))
                 elif act[1] == 'foundation':
                     if not fc.can_move_to_foundation(fc.tableau[tab_n].top()):
                         handled = True
                         self.set_message('Cannot move to foundation')
                     else:
                         acted = handled = True
-                        fc.move_to_foundation(fc.tableau[tab_n].pop())
+                        self.play(Move(TABLEAU, tab_n, FOUNDATION,
+                            fc.tableau[tab_n].top().face_index, 1))
                 elif isinstance(act[1], int):
                     dest_n = act[1]
                     if tab_n == dest_n:
@@ -460,7 +712,8 @@ class FreeCellGame(Game):
                             self.set_message('No free reserve slots')
                         else:
                             acted = handled = True
-                            fc.move_to_reserve(fc.tableau[tab_n].pop())
+                            self.play(Move(TABLEAU, tab_n, RESERVE,
+                                fc.reserve.index(None), 1))
                     elif dest_n not in range(fc.TABLEAU_SLOTS):
                         handled = True
                         self.set_message('Invalid tableau slot')
@@ -498,56 +751,203 @@ class FreeCellGame(Game):
                 self.set_message('Not enough reserve slots to move')
                 return False
 
-        fc.move_tableau_group(src, dest, n)
+        self.play(Move(TABLEAU, src, TABLEAU, dest, n))
         return True
 
-    def copy_state(self):
-        return self.freecell.copy()
+    def play(self, move):
+        '''
+        Performs a player Move and records it in undo history
+        '''
+        self.freecell.apply(move)
+        self.push_undo([move])
+        self.cancel_hint()
+        self.board_changed()
+
+    def hint(self):
+        '''
+        Begins searching for the best move from the current position,
+        displaying the best move found so far as the search continues
+        '''
+        self.hint_restart = False
+        if self.stopped:
+            return
+        # Cards still moving to foundation would change the position
+        self.skip_animation()
+        if self.hint_search is None:
+            # Hints are limited to moves which can be made with SLOT_KEYS,
+            # which always move as many cards as possible to an empty slot
+            self.hint_search = solver.Search(self.freecell,
+                self.position_cache, partial = False)
+            self.hint_message = None
+            self.run_hint(self.HINT_FIRST_SLICE)
+        else:
+            self.show_hint()
+
+    def hint_running(self):
+        s = self.hint_search
+        return s is not None and s.status is None and not self.paused
+
+    def run_hint(self, t):
+        '''
+        Continues the hint search for up to t seconds
+        '''
+        s = self.hint_search
+        s.run(self.HINT_MAX_NODES - s.nodes, time.perf_counter() + t)
+        if s.status is None and s.nodes >= self.HINT_MAX_NODES:
+            s.status = solver.UNKNOWN
+        self.show_hint()
+
+    def show_hint(self):
+        '''
+        Displays the first of the best moves found by the hint search
+        '''
+        s = self.hint_search
+        moves = s.best_moves()
+
+        if moves:
+            msg = 'Hint: {}'.format(self.describe_move(moves[0]))
+            if s.status is None:
+                msg += ' ...'
+            elif s.status == solver.SOLVED:
+                msg += ' (win in {})'.format(len(moves))
+            elif s.status == solver.UNKNOWN:
+                msg += ' (no solution found)'
+        elif s.status == solver.UNSOLVABLE:
+            msg = 'No solution from this position'
+        elif s.status is None:
+            msg = 'Hint: ...'
+        else:
+            return
+
+        if msg != self.hint_message:
+            self.hint_message = msg
+            self.set_message(msg, None)
+
+    def cancel_hint(self, restart = True):
+        '''
+        Abandons any hint search after the field has changed. If restart is
+        True, a search still in progress begins again from the new position
+        once cards have finished moving to foundation.
+        '''
+        s = self.hint_search
+        self.hint_restart = restart and s is not None and s.status is None
+        self.hint_search = None
+        if self.hint_message is not None:
+            if self.message == self.hint_message:
+                self.clear_message()
+            self.hint_message = None
+
+    def describe_move(self, move):
+        '''
+        Returns a string naming the card moved and the keys for a Move
+        '''
+        fc = self.freecell
+        keys = self.SLOT_KEYS
+
+        if move.src == RESERVE:
+            c = fc.reserve[move.src_index]
+            src = 'R ' + keys[move.src_index]
+        else:
+            c = fc.tableau[move.src_index].nth(move.n)
+            src = keys[move.src_index]
+
+        if move.dest == RESERVE:
+            dest = 'R'
+        elif move.dest == FOUNDATION:
+            dest = 'T'
+        else:
+            dest = keys[move.dest_index]
+
+        return '{} {:>2}  {} {}'.format(c.face_char, c.name, src, dest)
 
     def undo(self):
+        '''
+        Reverts the most recent undo entry.
+
+        Each entry in undo_list is a list of Moves: the player's move,
+        followed by any moves made by sweeping afterward. When undo_index
+        is not None, only the entries before it are currently applied.
+        '''
         if not self.undo_list:
             return
 
         if self.undo_index is None:
-            self.undo_index = len(self.undo_list) - 1
-            self.undo_list.append(self.freecell)
-            self.freecell = self.undo_list[self.undo_index]
-        elif self.undo_index != 0:
+            self.undo_index = len(self.undo_list)
+
+        if self.undo_index != 0:
             self.undo_index -= 1
-            self.freecell = self.undo_list[self.undo_index]
-        self.try_sweep = True
-        self.queue_redraw = True
+            self.undo_count += 1
+            fc = self.freecell
+            for move in reversed(self.undo_list[self.undo_index]):
+                fc.revert(move)
+            self.cancel_hint()
+        # Sweeping only continues at the end of undo history;
+        # otherwise, swept moves would conflict with redo entries.
+        self.stop_animation()
+        self.board_changed()
 
     def redo(self):
         if self.undo_index is not None:
+            fc = self.freecell
+            for move in self.undo_list[self.undo_index]:
+                fc.apply(move)
+            self.cancel_hint()
             self.undo_index += 1
             if self.undo_index == len(self.undo_list):
-                self.freecell = self.undo_list.pop(-1)
                 self.undo_index = None
-            else:
-                self.freecell = self.undo_list[self.undo_index]
-            self.try_sweep = True
-            self.queue_redraw = True
+                self.start_animation()
+            self.board_changed()
 
-    def push_undo(self, state):
+    def push_undo(self, entry):
         if self.undo_index is not None:
             del self.undo_list[self.undo_index:]
             self.undo_index = None
-        self.undo_list.append(state)
+        self.undo_list.append(entry)
 
     def new_game(self):
         if not self.stopped and self.undo_list:
-            self.stats.add_game()
+            self.record_game(history.LOST, self.game_time())
         self.start_game()
-        self.save_stats()
         self.queue_redraw = True
 
     def show_help(self):
         self.pause_game(self.help_callback, self.draw_help)
 
     def show_stats(self):
+        self.stats_report = None
         self.pause_game(self.stats_callback, self.draw_stats)
 
+    def stats_loading(self):
+        '''
+        Returns whether the stats screen is shown without a report
+        '''
+        return self.paused and self.stats_report is None and \
+            self.pause_draw_callback == self.draw_stats
+
+    def load_stats_report(self):
+        '''
+        Reads new games from the history log and computes the figures
+        shown on the stats screen
+        '''
+        columns = self.get_history_columns()
+        if self.backend.persist:
+            try:
+                columns.update(self.history)
+            except (OSError, ValueError) as e:
+                self.set_message('Failed to load file: {}'.format(e))
+
+        streaks = columns.streaks()
+
+        self.stats_report = {
+            'week': columns.period_win_rate('week'),
+            'month': columns.period_win_rate('month'),
+            'median': columns.time_percentile(50),
+            'p90': columns.time_percentile(90),
+            'streak': streaks.current,
+            'best_streak': streaks.longest_won,
+        }
+        self.queue_redraw = True
+
     def help_callback(self, ch):
         if ch in { ord('p'), ord(' '), ctrl('[') }:
             self.unpause_game()
@@ -577,31 +977,160 @@ class FreeCellGame(Game):
         return True
 
     def clear_stats(self):
-        self.stats.clear()
-        self.save_stats()
+        self.add_history(history.Record(int(time.time()), 0, 0, 0, 0,
+            history.CLEARED))
+        self.stats_report = None
         self.queue_redraw = True
 
+    def record_game(self, outcome, game_time):
+        '''
+        Adds the current game to the history log and RECORDS_FILE
+        '''
+        moves = len(self.undo_list[:self.undo_index])
+        self.add_history(history.Record(int(time.time()), self.deal_number,
+            game_time, moves, self.undo_count, outcome))
+        self.save_record(game_time)
+
+    def add_history(self, rec):
+        '''
+        Appends a record to the history log and updates stats
+        '''
+        if not self.backend.persist:
+            self.stats.add_record(rec)
+            self.get_history_columns().append(rec)
+            return
+
+        try:
+            os.makedirs(os.path.dirname(self.history.path), 0o755,
+                exist_ok = True)
+            self.history.append([rec])
+        except OSError as e:
+            self.set_message('Failed to save file: {}'.format(e))
+            return
+        self.update_stats()
+
+    def get_history_columns(self):
+        if self.history_columns is None:
+            # Imported here, so as not to delay startup
+            import analytics
+            self.history_columns = analytics.Columns()
+        return self.history_columns
+
+    def update_stats(self):
+        '''
+        Counts games added to the history log since stats were last updated
+        '''
+        if not self.backend.persist:
+            return
+        records = self.stats.records
+        try:
+            self.stats.update(self.history)
+        except (OSError, ValueError) as e:
+            self.set_message('Failed to load file: {}'.format(e))
+        if self.stats.records != records:
+            self.save_stats()
+
     def save_stats(self):
         self.save_config(self.STATS_FILE, self.stats.save())
 
-    def start_game(self):
-        self.freecell = FreeCell(shuffled(make_deck()))
+    def game_moves(self):
+        '''
+        Returns a list of all Moves currently applied since the deal,
+        including those made by sweeping
+        '''
+        moves = list(self.start_moves)
+        for entry in self.undo_list[:self.undo_index]:
+            moves.extend(entry)
+        return moves
+
+    def save_record(self, game_time):
+        '''
+        Appends a record of the current game to RECORDS_FILE
+        '''
+        if not self.backend.persist:
+            return
+        record = replay.Record(self.deal_number, game_time,
+            replay.encode_moves(self.game_moves()))
+        try:
+            p = os.path.expanduser(self.RECORDS_FILE)
+            os.makedirs(os.path.dirname(p), 0o755, exist_ok = True)
+            replay.append_record(p, record)
+        except (IOError, ValueError) as e:
+            self.set_message('Failed to save file: {}'.format(e))
+
+    def next_deal_filter(self):
+        '''
+        Selects the next of DEAL_FILTERS for new games
+        '''
+        names = [name for name, _ in self.DEAL_FILTERS]
+        name = self.options.get('deals', 'any')
+        i = names.index(name) + 1 if name in names else 0
+        name = names[i % len(names)]
+
+        self.options['deals'] = name
+        self.save_config(self.OPTIONS_FILE, self.options)
+        self.set_message('New games: {} deals'.format(name))
+
+    def choose_deal(self):
+        '''
+        Returns a deal number for a new game, according to the deal filter
+        '''
+        bounds = dict(self.DEAL_FILTERS).get(self.options.get('deals'))
+
+        if bounds is not None:
+            if self.deal_index is None:
+                try:
+                    self.deal_index = DealIndex(
+                        os.path.expanduser(self.DEAL_INDEX_FILE))
+                except (OSError, ValueError):
+                    self.deal_index = False
+
+            if not self.deal_index:
+                self.set_message('No deal index; choosing any deal', 3)
+            else:
+                n = self.deal_index.choose(*bounds)
+                if n is not None:
+                    return n
+                self.set_message('No such deals in index; '
+                    'choosing any deal', 3)
+
+        return random.randint(1, self.NUM_DEALS)
+
+    def start_game(self, deal_number = None):
+        if deal_number is None:
+            deal_number = self.choose_deal()
+        self.deal_number = deal_number
+        self.freecell = FreeCell(deal(self.deal_number))
         self.paused = False
         self.stopped = False
-        self.try_sweep = True
+        self.start_animation()
         self.time_offset = time.time()
+        del self.start_moves[:]
         del self.undo_list[:]
         self.undo_index = None
+        self.undo_count = 0
+        self.cancel_hint(False)
+        self.board_changed()
 
-    def sweep_step(self):
-        if self.freecell.sweep_step(3):
-            self.queue_redraw = True
-            if self.freecell.won():
-                self.game_won()
-        else:
-            self.try_sweep = False
+    def sweep_step(self, n = 1):
+        '''
+        Sweeps up to n cards to foundation and returns whether sweeping
+        should continue
+        '''
+        # Swept moves are undone along with the latest player move
+        moves = self.undo_list[-1] if self.undo_list else self.start_moves
+        if not self.freecell.sweep_step(n, moves):
+            return False
+
+        self.board_changed()
+        if self.freecell.won():
+            self.game_won()
+            return False
+        return True
 
     def load_config(self, fname):
+        if not self.backend.persist:
+            return {}
         try:
             with open(os.path.expanduser(fname), 'r') as f:
                 return json.load(f)
@@ -609,13 +1138,27 @@ class FreeCellGame(Game):
             return {}
 
     def save_config(self, fname, cfg):
+        '''
+        Writes cfg to a file, replacing it only once the new contents
+        are written in full
+        '''
+        if not self.backend.persist:
+            return
         try:
             p = os.path.expanduser(fname)
             os.makedirs(os.path.dirname(p), 0o755, exist_ok = True)
 
-            with open(p, 'w') as f:
-                json.dump(cfg, f)
-                f.write('\n')
+            # Named for this process, since other sessions may be saving
+            tmp = '{}.{}.tmp'.format(p, os.getpid())
+            f = open(tmp, 'w')
+            try:
+                with f:
+                    json.dump(cfg, f)
+                    f.write('\n')
+                os.replace(tmp, p)
+            except BaseException:
+                os.unlink(tmp)
+                raise
         except IOError as e:
             self.set_message('Failed to save file: {}'.format(e))
 
@@ -3,34 +3,387 @@
 
 import curses
 from functools import partial
+import os
+import selectors
 import signal
+import sys
 import time
 
+import instrument
+
 __all__ = [
     'ctrl', 'main', 'time_str',
-    'Game',
+    'BufferScreen', 'Canvas', 'CursesBackend', 'Game', 'HeadlessBackend',
 ]
 
 def ctrl(ch):
     return ord(ch) & 0x1f
 
 def main(game_class):
+    recorder = instrument.from_environ()
+    if recorder is not None:
+        recorder.install(game_class)
+
     stdscr = curses.initscr()
     try:
-        game_class(stdscr).go()
+        game_class(CursesBackend(stdscr)).go()
     finally:
-        curses.endwin()
+        try:
+            curses.endwin()
+        except curses.error:
+            # The terminal has been closed
+            pass
+        if recorder is not None and recorder.trace_path:
+            recorder.write_trace()
 
 def time_str(sec):
     '''Returns a string "minutes:seconds" for the given time, in seconds'''
     return '{:d}:{:02d}'.format(*divmod(int(sec), 60))
 
-class Game(object):
+class Canvas(object):
 
-    GAME_TITLE = NotImplemented
+    '''
+    Model of the terminal screen contents, drawn to using the coordinates
+    and methods of a curses window. Drawing only updates the model;
+    flush writes to the terminal those cells whose character or attributes
+    differ from what was last written.
+
+    The terminal is divided into separate windows for the header line,
+    the field, and the message line. Only windows containing changed cells
+    are refreshed.
+    '''
+
+    BLANK = (' ', 0)
+
+    def __init__(self, stdscr):
+        self.stdscr = stdscr
+        self.resize()
+
+    def resize(self):
+        '''
+        Recreates windows to fit the terminal size and invalidates the screen
+        '''
+        y, x = self.size = self.stdscr.getmaxyx()
+
+        # Input is read from stdscr, which is refreshed by getch if it has
+        # changed; mark it unchanged so that it does not paint over windows.
+        self.stdscr.noutrefresh()
+
+        if y >= 3:
+            bands = [(0, 1), (1, y - 1), (y - 1, y)]
+        else:
+            bands = [(0, y)]
+
+        self.windows = []
+        # Maps each row to (first row of window, window)
+        self.rows = []
+
+        for top, bottom in bands:
+            win = curses.newwin(bottom - top, x, top, 0)
+            self.windows.append(win)
+            self.rows.extend((top, win) for i in range(top, bottom))
+
+        self.cells = {}
+        self.cursor = (0, 0)
+        self.invalidate()
+
+    def invalidate(self):
+        '''
+        Causes the next flush to repaint the entire terminal
+        '''
+        self.shown = {}
+        for win in self.windows:
+            win.clear()
+        self.full_refresh = True
+
+    def getmaxyx(self):
+        return self.size
+
+    def erase(self):
+        '''Clears the model; the terminal is unchanged until flush'''
+        self.cells = {}
+
+    def move(self, y, x):
+        self.cursor = (y, x)
+
+    def addstr(self, *args):
+        '''
+        Draws a string: addstr([y, x,] s[, attr]).
+        Raises curses.error if the string does not fit on the screen.
+        '''
+        if isinstance(args[0], str):
+            (y, x), args = self.cursor, args
+        else:
+            y, x, *args = args
+
+        s = args[0]
+        attr = args[1] if len(args) > 1 else 0
+
+        h, w = self.size
+        if not (0 <= y < h and 0 <= x and x + len(s) <= w):
+            raise curses.error('addstr() outside of screen')
+
+        cells = self.cells
+        for i, ch in enumerate(s, x):
+            cells[y, i] = (ch, attr)
+
+        self.cursor = (y, x + len(s))
+
+    def chgat(self, y, x, n, attr):
+        '''Sets the attributes of n cells, starting at the given position'''
+        cells = self.cells
+        for i in range(x, min(x + n, self.size[1])):
+            cells[y, i] = (cells.get((y, i), self.BLANK)[0], attr)
+
+    def flush(self):
+        '''
+        Writes changed cells to the terminal
+        '''
+        cells = self.cells
+        shown = self.shown
+
+        changed = [pos for pos, cell in cells.items() if shown.get(pos) != cell]
+        changed.extend(pos for pos in shown if pos not in cells)
+
+        if self.full_refresh:
+            touched = set(self.windows)
+            self.full_refresh = False
+        elif changed:
+            touched = set()
+        else:
+            return
+
+        changed.sort()
+        blank = self.BLANK
+
+        # Write runs of adjacent cells sharing attributes in one call
+        run_y = run_x = run_attr = None
+        run = []
+
+        for y, x in changed:
+            ch, attr = cells.get((y, x), blank)
+            if y == run_y and x == run_x + len(run) and attr == run_attr:
+                run.append(ch)
+            else:
+                if run:
+                    touched.add(self._write(run_y, run_x, ''.join(run), run_attr))
+                run_y, run_x, run_attr = y, x, attr
+                run = [ch]
+
+        if run:
+            touched.add(self._write(run_y, run_x, ''.join(run), run_attr))
+
+        self.shown = dict(cells)
+
+        for win in self.windows:
+            if win in touched:
+                win.noutrefresh()
+        curses.doupdate()
+
+    def _write(self, y, x, s, attr):
+        top, win = self.rows[y]
+        try:
+            win.addstr(y - top, x, s, attr)
+        except curses.error:
+            # Writing the last cell of a window fails after the cell is
+            # written, because the cursor cannot advance.
+            pass
+        return win
+
+class BufferScreen(Canvas):
+
+    '''
+    A Canvas of the given size which is never written to a terminal.
+    Its contents are read with lines.
+    '''
+
+    def __init__(self, size):
+        self.stdscr = None
+        self.size = size
+        self.windows = []
+        self.rows = []
+        self.cells = {}
+        self.cursor = (0, 0)
+        self.invalidate()
+
+    def resize(self):
+        self.invalidate()
+
+    def flush(self):
+        pass
+
+    def lines(self):
+        '''
+        Returns the text of each line of the screen
+        '''
+        h, w = self.size
+        cells = self.cells
+        blank = self.BLANK
+        return [''.join(cells.get((y, x), blank)[0] for x in range(w)).rstrip()
+            for y in range(h)]
+
+class CursesBackend(object):
+
+    '''
+    Draws a Game to the terminal and reads its input, through curses
+    '''
+
+    # Whether games may load and save their files
+    persist = True
 
     def __init__(self, stdscr):
         self.stdscr = stdscr
+        self.game = None
+        self.selector = None
+        self.wakeup_fd = None
+
+    def open(self, game):
+        '''
+        Prepares the terminal and returns the screen for game to draw to
+        '''
+        self.game = game
+        self.stdscr.nodelay(True)
+        curses.curs_set(0)
+        curses.noecho()
+        screen = Canvas(self.stdscr)
+
+        # The main loop sleeps until input is ready on the terminal or a
+        # signal is delivered, which writes to the wakeup pipe.
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(sys.stdin.fileno(), selectors.EVENT_READ)
+        self.wakeup_fd, wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_fd, False)
+        os.set_blocking(wakeup_w, False)
+        self.selector.register(self.wakeup_fd, selectors.EVENT_READ)
+        signal.set_wakeup_fd(wakeup_w)
+
+        signal.signal(signal.SIGWINCH, self.resized)
+        # The game ends normally, as though the player had quit,
+        # when the terminal is closed or the process is asked to exit
+        for sig in (signal.SIGHUP, signal.SIGTERM):
+            signal.signal(sig, self.terminated)
+        curses.start_color()
+        curses.use_default_colors()
+        return screen
+
+    def close(self):
+        for sig in (signal.SIGHUP, signal.SIGTERM):
+            signal.signal(sig, signal.SIG_DFL)
+        os.close(signal.set_wakeup_fd(-1))
+        os.close(self.wakeup_fd)
+        self.selector.close()
+
+    def wait(self, timeout):
+        '''
+        Waits until input is available, a signal is received,
+        or timeout seconds pass; timeout may be None
+        '''
+        for key, _ in self.selector.select(timeout):
+            if key.fd == self.wakeup_fd:
+                try:
+                    while os.read(self.wakeup_fd, 512):
+                        pass
+                except BlockingIOError:
+                    pass
+
+    def getch(self):
+        '''
+        Returns an input character; -1 if none is available,
+        or None if input has ended
+        '''
+        return self.stdscr.getch()
+
+    def resized(self, *args):
+        curses.endwin()
+        curses.initscr()
+        self.game.win_resized()
+
+    def terminated(self, *args):
+        self.game.quit_game()
+
+    def color_pair(self, n):
+        return curses.color_pair(n)
+
+    def init_pair(self, n, fg, bg):
+        curses.init_pair(n, fg, bg)
+
+class HeadlessBackend(object):
+
+    '''
+    Runs a Game without a terminal, taking input from an iterable of keys,
+    either characters or integer key codes. Input ends after the last key.
+
+    If render is True, the game draws to a BufferScreen of the given size,
+    which is available as screen; otherwise, nothing is drawn.
+
+    Keys are delivered one at a time, between passes of the main loop,
+    with no waiting. If settle is True, then before each key and before
+    input ends, animations are completed and any work the game has
+    scheduled to run at once is allowed to finish, as though the player
+    had waited for them.
+
+    Games do not load or save files unless persist is True.
+    '''
+
+    def __init__(self, keys, size = (30, 80), render = True, settle = True,
+            persist = False):
+        self.keys = iter(keys)
+        self.size = size
+        self.render = render
+        self.settle = settle
+        self.persist = persist
+        self.game = None
+        self.screen = None
+        self.delivered = False
+
+    def open(self, game):
+        self.game = game
+        if self.render:
+            self.screen = BufferScreen(self.size)
+        return self.screen
+
+    def close(self):
+        pass
+
+    def wait(self, timeout):
+        pass
+
+    def getch(self):
+        # Returning -1 after each key ends a pass of the main loop
+        if self.delivered:
+            self.delivered = False
+            return -1
+        if self.settle:
+            if self.game.animating:
+                self.game.skip_animation()
+                return -1
+            deadline = self.game.next_deadline()
+            if deadline is not None and deadline <= time.time():
+                return -1
+
+        ch = next(self.keys, None)
+        if isinstance(ch, str):
+            ch = ord(ch)
+        self.delivered = ch is not None
+        return ch
+
+    def color_pair(self, n):
+        return n << 8
+
+    def init_pair(self, n, fg, bg):
+        pass
+
+class Game(object):
+
+    GAME_TITLE = NotImplemented
+
+    # Frames per second of animations; see start_animation
+    ANIMATION_FPS = 30
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.animating = False
+        self.frame_time = None
         self.grab_input_callbacks = []
         self.key_callbacks = NotImplemented
         self.message = None
@@ -39,6 +392,7 @@ class Game(object):
         self.pause_draw_callback = None
         self.queue_redraw = True
         self.quit = False
+        self.screen = None
         self.stopped = False
 
     def clear_grab(self):
@@ -69,9 +423,10 @@ class Game(object):
         '''
         Input grab callback used by prompt_confirmation.
         '''
+        # Cleared first, so that cb may set its own message
+        self.clear_message()
         if ch == ord('y'):
             cb()
-        self.clear_message()
         return False
 
     def clear_message(self):
@@ -99,10 +454,10 @@ class Game(object):
         '''
         Draws the contents of the screen
         '''
-        win = self.stdscr
+        win = self.screen
 
         y, x = win.getmaxyx()
-        win.clear()
+        win.erase()
 
         try:
             self.draw_title(y, x)
@@ -119,8 +474,9 @@ class Game(object):
             self.refresh()
         except curses.error as e:
             msg = 'Screen is too small'
+            win.erase()
             self.draw_line(y - 1, 0, msg[:x], curses.A_BOLD)
-            win.refresh()
+            self.refresh()
 
     def draw_field(self, y, x):
         raise NotImplementedError
@@ -136,11 +492,11 @@ class Game(object):
     def draw_clock(self, y, x):
         '''Draws the timer on the screen'''
         s = self.timer_str()
-        self.stdscr.addstr(0, x - len(s) - 1, s, curses.A_REVERSE)
+        self.screen.addstr(0, x - len(s) - 1, s, curses.A_REVERSE)
 
     def draw_message(self, y, x):
         '''Draws message'''
-        win = self.stdscr
+        win = self.screen
         if self.message:
             win.addstr(y - 1, 0, self.message, curses.A_BOLD)
 
@@ -160,52 +516,150 @@ class Game(object):
         Draws a string centered on the screen.
         y is line to draw, x is the max x value of the screen.
         '''
-        self.stdscr.addstr(y, (x - len(s)) // 2, s, attr)
+        self.screen.addstr(y, (x - len(s)) // 2, s, attr)
 
     def draw_line(self, y, x, s, attr = 0):
-        self.stdscr.addstr(y, x, s, attr)
+        self.screen.addstr(y, x, s, attr)
 
     def draw_title(self, y, x):
         '''Draws the title to the screen'''
-        self.stdscr.addstr(0, 1, self.GAME_TITLE)
-        self.stdscr.chgat(0, 0, x, curses.A_REVERSE)
+        self.screen.addstr(0, 1, self.GAME_TITLE)
+        self.screen.chgat(0, 0, x, curses.A_REVERSE)
 
     def go(self):
         self.init_ui()
-        self.start_game()
+        if not self.resume_game():
+            self.start_game()
+        self.run()
+        self.end_game()
+        self.close_ui()
 
+    def run(self):
+        '''
+        Runs the main loop of a started game until it quits
+        '''
         while not self.quit:
             self.before_tick()
 
-            if self.queue_redraw:
+            if self.screen is None:
+                # The backend does not render
+                self.queue_redraw = False
+            elif self.queue_redraw:
                 self.draw()
                 self.queue_redraw = False
             elif not (self.paused or self.stopped):
-                self.draw_clock(*self.stdscr.getmaxyx())
+                self.draw_clock(*self.screen.getmaxyx())
                 self.refresh()
 
+            self.wait_input()
             self.handle_input()
 
             self.after_tick()
 
-        self.end_game()
+    def next_deadline(self):
+        '''
+        Returns the time at which the main loop must next wake to update
+        the game, or None if it may wait indefinitely for input.
+        Subclasses may extend this to schedule their own updates.
+        '''
+        deadlines = []
+
+        if self.message_timeout is not None:
+            deadlines.append(self.message_timeout)
+
+        if not (self.paused or self.stopped):
+            # Wake when the displayed clock changes
+            elapsed = time.time() - self.time_offset
+            deadlines.append(self.time_offset + int(elapsed) + 1)
+
+        if self.animating and not self.paused:
+            deadlines.append(self.frame_time)
+
+        return min(deadlines, default = None)
+
+    def wait_input(self):
+        '''
+        Waits until input is available, a signal is received,
+        or the next deadline passes
+        '''
+        deadline = self.next_deadline()
+        if deadline is None:
+            timeout = None
+        else:
+            timeout = max(0, deadline - time.time())
+
+        self.backend.wait(timeout)
 
     def after_tick(self):
         if self.message_timeout and self.message_timeout <= time.time():
             self.clear_message()
 
     def before_tick(self):
-        pass
+        if self.animating and not self.paused:
+            now = time.time()
+            if now >= self.frame_time:
+                # The next frame is scheduled from now, rather than from
+                # when this frame was due, so that frames delayed by input
+                # handling are dropped instead of queued.
+                self.frame_time = now + 1 / self.ANIMATION_FPS
+                if not self.animate():
+                    self.animating = False
+
+    def start_animation(self):
+        '''
+        Begins an animation: animate is called once per frame,
+        beginning immediately, until it returns False.
+        Animation is suspended while the game is paused.
+        '''
+        if not self.animating:
+            self.animating = True
+            self.frame_time = time.time()
+
+    def stop_animation(self):
+        self.animating = False
+
+    def skip_animation(self):
+        '''
+        Completes the current animation at once, with a single redraw
+        '''
+        if self.animating:
+            self.animating = False
+            self.finish_animation()
+            self.queue_redraw = True
+
+    def animate(self):
+        '''
+        Draws one frame of animation and returns whether to continue
+        '''
+        return False
+
+    def finish_animation(self):
+        '''
+        Completes the current animation; by default, animate is called
+        until it returns False
+        '''
+        while self.animate():
+            pass
 
     def end_game(self):
         pass
 
     def handle_input(self):
-        ch = self.stdscr.getch()
+        '''
+        Handles all pending input characters
+        '''
+        while not self.quit:
+            ch = self.backend.getch()
 
-        if ch == -1:
-            return
+            if ch is None:
+                self.quit = True
+                break
+            if ch == -1:
+                break
+
+            self.handle_key(ch)
 
+    def handle_key(self, ch):
         if self.grab_input_callbacks:
             cb = self.grab_input_callbacks[-1]
             if not cb(ch):
@@ -216,15 +670,17 @@ class Game(object):
                 cb()
 
     def init_ui(self):
-        self.stdscr.timeout(100)
-        curses.curs_set(0)
-        curses.noecho()
-        signal.signal(signal.SIGWINCH, self.win_resized)
+        self.screen = self.backend.open(self)
         self.init_colors()
 
+    def close_ui(self):
+        self.backend.close()
+
     def init_colors(self):
-        curses.start_color()
-        curses.use_default_colors()
+        '''
+        Called once the backend is open to initialize color pairs
+        '''
+        pass
 
     def toggle_pause(self):
         if self.paused:
@@ -270,13 +726,24 @@ class Game(object):
     def start_game(self):
         raise NotImplementedError
 
+    def resume_game(self):
+        '''
+        Called instead of start_game when the game begins, to resume a game
+        saved by end_game. Returns whether a game was resumed.
+        '''
+        return False
+
     def redraw(self):
+        if self.screen is not None:
+            self.screen.invalidate()
         self.queue_redraw = True
 
     def refresh(self):
-        self.stdscr.refresh()
+        self.screen.flush()
 
-    def win_resized(self, *args):
-        curses.endwin()
-        curses.initscr()
+    def win_resized(self):
+        '''
+        Called by the backend when the terminal has been resized
+        '''
+        self.screen.resize()
         self.queue_redraw = True
@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+# -*- coding: utf-8
+
+'''
+Runs scripted FreeCell sessions without a terminal.
+
+A key script is a string of keys, typed as in the game; "^X" is Control-X
+and "^^" is a literal "^". Each session plays one script on a fresh game
+and stops when the script ends:
+
+    python3 headless.py --deal 1 --keys 'ajsk'
+    python3 headless.py --deal 1 --repeat 100 --no-render scripts.txt
+
+Each line of a script file is a separate script. Files and options are
+never read from or written to the player's configuration.
+'''
+
+import argparse
+import sys
+import time
+
+from freecell_game import FreeCellGame
+from game import HeadlessBackend, ctrl
+
+__all__ = [
+    'main', 'parse_keys', 'run_session',
+]
+
+def parse_keys(script):
+    '''
+    Returns the list of key codes given by a key script
+    '''
+    keys = []
+    chars = iter(script)
+
+    for ch in chars:
+        if ch == '^':
+            ch = next(chars, None)
+            if ch is None:
+                raise ValueError('incomplete control key in script')
+            keys.append(ord(ch) if ch == '^' else ctrl(ch))
+        else:
+            keys.append(ord(ch))
+
+    return keys
+
+def run_session(keys, deal_number = None, render = True,
+        game_class = FreeCellGame, size = (30, 80)):
+    '''
+    Plays an iterable of keys on a new game of the given deal number,
+    or a random deal if None, and returns the game when input ends
+    '''
+    backend = HeadlessBackend(keys, size, render)
+    game = game_class(backend)
+    game.init_ui()
+    try:
+        game.start_game(deal_number)
+        game.run()
+        game.end_game()
+    finally:
+        game.close_ui()
+    return game
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = 'headless.py',
+        description = 'Run scripted FreeCell sessions without a terminal')
+    parser.add_argument('files', nargs = '*', metavar = 'file',
+        help = 'file of key scripts, one per line')
+    parser.add_argument('--keys', '-k', action = 'append', default = [],
+        metavar = 'SCRIPT', help = 'key script to run')
+    parser.add_argument('--deal', '-d', type = int,
+        help = 'deal number of each session (default: random)')
+    parser.add_argument('--repeat', '-r', type = int, default = 1,
+        help = 'number of times to run each script (default: %(default)s)')
+    parser.add_argument('--no-render', dest = 'render',
+        action = 'store_false', help = 'do not draw the screen')
+    parser.add_argument('--screen', '-s', action = 'store_true',
+        help = 'print the final screen of each session')
+
+    args = parser.parse_args(argv)
+
+    if args.repeat < 1:
+        parser.error('--repeat must be at least 1')
+    if args.screen and not args.render:
+        parser.error('--screen cannot be used with --no-render')
+
+    scripts = list(args.keys)
+    try:
+        for name in args.files:
+            with open(name) as f:
+                scripts.extend(line.rstrip('\n') for line in f)
+        scripts = [parse_keys(s) for s in scripts]
+    except (OSError, ValueError) as e:
+        print('{}: {}'.format(parser.prog, e), file = sys.stderr)
+        return 1
+
+    if not scripts:
+        parser.error('no key scripts given')
+
+    sessions = 0
+    start = time.perf_counter()
+
+    for keys in scripts:
+        for i in range(args.repeat):
+            game = run_session(keys, args.deal, args.render)
+            sessions += 1
+
+        fc = game.freecell
+        print('deal {} {} after {} moves'.format(game.deal_number,
+            'won' if fc.won() else 'unfinished', len(game.game_moves())))
+        if args.screen:
+            print('\n'.join(game.screen.lines()).rstrip('\n'))
+
+    elapsed = time.perf_counter() - start
+    print('{} sessions in {:.3f}s ({:.1f} sessions/s)'.format(
+        sessions, elapsed, sessions / elapsed if elapsed else 0),
+        file = sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
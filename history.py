@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+# -*- coding: utf-8
+
+'''
+Append-only log of finished games.
+
+A history file begins with MAGIC, followed by fixed size records, one for
+each game: the time at which it ended, deal number, duration in seconds,
+number of moves, number of undos, and outcome. A record with the outcome
+CLEARED marks the point at which the player cleared their stats.
+
+Integers are little-endian. Records are only ever appended, under an
+exclusive lock, in a single write followed by fsync; several sessions may
+share one file. A record left incomplete by a crash is discarded by the
+next append.
+'''
+
+from collections import namedtuple
+import fcntl
+import os
+import struct
+
+__all__ = [
+    'CHUNK', 'CLEARED', 'LOST', 'MAGIC', 'RECORD_SIZE', 'WON',
+    'HistoryLog', 'Record',
+]
+
+MAGIC = b'FCHL\x01\x00\x00\x00'
+
+# Outcomes
+LOST = 0
+WON = 1
+CLEARED = 2
+
+_RECORD = struct.Struct('<IIIHHBxxx')
+RECORD_SIZE = _RECORD.size
+
+# Records read at a time by HistoryLog.read_chunks
+CHUNK = 65536
+
+class Record(namedtuple('Record', 'time deal duration moves undos outcome')):
+
+    '''
+    A finished game: end time, deal number, duration in seconds,
+    number of moves and of undos, and outcome
+    '''
+
+    __slots__ = ()
+
+    def pack(self):
+        return _RECORD.pack(self.time, self.deal, self.duration,
+            min(self.moves, 0xffff), min(self.undos, 0xffff), self.outcome)
+
+class HistoryLog(object):
+
+    '''
+    A history file at the given path, which need not exist until
+    the first append
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def __len__(self):
+        '''Returns the number of complete records in the file'''
+        try:
+            size = os.stat(self.path).st_size
+        except FileNotFoundError:
+            return 0
+        return max(0, size - len(MAGIC)) // RECORD_SIZE
+
+    def append(self, records):
+        '''
+        Appends an iterable of Records in a single write, creating the file
+        if it does not exist. Returns once the records are on disk.
+        '''
+        data = b''.join(r.pack() for r in records)
+
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            # Released when fd is closed
+            fcntl.flock(fd, fcntl.LOCK_EX)
+
+            size = os.fstat(fd).st_size
+            if size < len(MAGIC):
+                os.ftruncate(fd, 0)
+                data = MAGIC + data
+            elif (size - len(MAGIC)) % RECORD_SIZE:
+                # Discard the incomplete record written by a crashed session
+                os.ftruncate(fd, size - (size - len(MAGIC)) % RECORD_SIZE)
+
+            while data:
+                data = data[os.write(fd, data):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def read(self, start = 0):
+        '''
+        Yields each Record in the file, beginning with record number start.
+        An incomplete record at the end of the file is ignored. Raises
+        ValueError if the file is not a history file.
+        '''
+        make = Record._make
+        for data in self.read_chunks(start):
+            for fields in _RECORD.iter_unpack(data):
+                yield make(fields)
+
+    def read_chunks(self, start = 0):
+        '''
+        Yields the packed records of the file, beginning with record number
+        start, as bytes objects of up to CHUNK whole records
+        '''
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+
+        with f:
+            magic = f.read(len(MAGIC))
+            if len(magic) < len(MAGIC):
+                # Empty, or being created by another session
+                return
+            if magic != MAGIC:
+                raise ValueError('not a game history file: {}'.format(
+                    self.path))
+
+            f.seek(len(MAGIC) + start * RECORD_SIZE)
+
+            while True:
+                data = f.read(CHUNK * RECORD_SIZE)
+                end = len(data) - len(data) % RECORD_SIZE
+                if end:
+                    yield data[:end] if end != len(data) else data
+                if len(data) < CHUNK * RECORD_SIZE:
+                    return
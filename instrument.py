@@ -0,0 +1,256 @@
+#!/usr/bin/python3
+# -*- coding: utf-8
+
+'''
+Opt-in instrumentation of the FreeCell engine and game loop.
+
+Instrumentation is enabled by environment variables:
+
+    FREECELL_TRACE=FILE     write a Chrome trace (chrome://tracing, Perfetto)
+                            of timed calls to FILE when the game exits
+    FREECELL_OVERLAY=1      show recent timings at the top of the screen
+
+When neither is set, nothing is installed and there is no overhead.
+'''
+
+from collections import deque
+from functools import wraps
+import json
+import os
+import time
+
+__all__ = [
+    'ENGINE_METHODS', 'GAME_METHODS', 'Recorder', 'from_environ',
+]
+
+# FreeCell methods timed by Recorder.install
+ENGINE_METHODS = (
+    'apply', 'revert', 'copy', 'sweep', 'sweep_step', 'move_capacity',
+    'move_to_foundation', 'move_to_tableau', 'move_tableau_group',
+    'move_to_reserve', 'move_from_reserve',
+)
+
+# Game methods timed by Recorder.install; these are the phases of Game.go
+# and the drawing and input handling within them
+GAME_METHODS = (
+    'before_tick', 'draw', 'refresh', 'wait_input', 'handle_input',
+    'handle_key', 'after_tick',
+)
+
+class Recorder(object):
+
+    '''
+    Collects the number and duration of calls to instrumented methods,
+    along with frame intervals and input-to-paint latency.
+
+    Trace events are kept for up to max_events calls, the oldest being
+    discarded first; totals are kept for all calls.
+    '''
+
+    # Number of recent durations averaged for the overlay
+    RECENT = 32
+
+    def __init__(self, trace_path = None, overlay = False,
+            max_events = 500000):
+        self.trace_path = trace_path
+        self.overlay = overlay
+        self.start = time.perf_counter()
+        self.events = deque(maxlen = max_events)
+        # Maps name to [count, total seconds, max seconds]
+        self.totals = {}
+        self.recent = {}
+        self.installed = []
+        # Time at which the earliest input not yet painted was handled
+        self.input_time = None
+        self.last_paint = None
+
+    def record(self, name, cat, start, end):
+        '''
+        Records a call to name between the given perf_counter times
+        '''
+        dur = end - start
+        t = self.totals.get(name)
+        if t is None:
+            t = self.totals[name] = [0, 0.0, 0.0]
+            self.recent[name] = deque(maxlen = self.RECENT)
+        t[0] += 1
+        t[1] += dur
+        if dur > t[2]:
+            t[2] = dur
+        self.recent[name].append(dur)
+        self.events.append((name, cat, start, dur))
+
+    def average(self, name):
+        '''
+        Returns the average of recent durations of name, or None
+        '''
+        recent = self.recent.get(name)
+        if not recent:
+            return None
+        return sum(recent) / len(recent)
+
+    def wrap(self, cls, name, cat):
+        '''
+        Replaces method name of cls with one which records its calls
+        '''
+        fn = getattr(cls, name)
+        key = '{}.{}'.format(cls.__name__, name)
+        record = self.record
+        clock = time.perf_counter
+
+        @wraps(fn)
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record(key, cat, start, clock())
+
+        self.installed.append((cls, name, cls.__dict__.get(name)))
+        setattr(cls, name, timed)
+
+    def install(self, game_class):
+        '''
+        Instruments FreeCell and the given Game subclass
+        '''
+        from freecell import FreeCell
+
+        for name in ENGINE_METHODS:
+            self.wrap(FreeCell, name, 'engine')
+        for name in GAME_METHODS:
+            self.wrap(game_class, name, 'game')
+
+        # Latency and overlay hooks are installed last, so that they are
+        # called within the timed methods.
+        recorder = self
+        handle_key = game_class.handle_key
+        refresh = game_class.refresh
+
+        @wraps(handle_key)
+        def key_hook(game, ch):
+            if recorder.input_time is None:
+                recorder.input_time = time.perf_counter()
+            return handle_key(game, ch)
+
+        @wraps(refresh)
+        def refresh_hook(game):
+            if recorder.overlay:
+                recorder.draw_overlay(game)
+            refresh(game)
+            recorder.painted()
+
+        self.installed.append((game_class, 'handle_key', handle_key))
+        self.installed.append((game_class, 'refresh', refresh))
+        game_class.handle_key = key_hook
+        game_class.refresh = refresh_hook
+
+    def uninstall(self):
+        '''
+        Restores all instrumented methods
+        '''
+        for cls, name, fn in reversed(self.installed):
+            if fn is None:
+                delattr(cls, name)
+            else:
+                setattr(cls, name, fn)
+        del self.installed[:]
+
+    def painted(self):
+        '''
+        Called after the screen is written to the terminal
+        '''
+        now = time.perf_counter()
+        if self.last_paint is not None:
+            self.record('frame', 'frame', self.last_paint, now)
+        self.last_paint = now
+        if self.input_time is not None:
+            self.record('latency', 'latency', self.input_time, now)
+            self.input_time = None
+
+    def overlay_text(self):
+        '''
+        Returns a line summarizing recent timings, in milliseconds
+        '''
+        parts = []
+        for label, name in [
+                ('draw', 'draw'), ('flush', 'refresh'),
+                ('sweep', 'sweep_step'), ('key', 'handle_key'),
+                ('lat', 'latency'), ('frame', 'frame')]:
+            if name in ('latency', 'frame'):
+                key = name
+            else:
+                key = next((k for k in self.totals
+                    if k.endswith('.' + name)), None)
+            avg = self.average(key) if key else None
+            if avg is not None:
+                parts.append('{} {:.2f}'.format(label, avg * 1000))
+
+        redraws = sum(t[0] for k, t in self.totals.items()
+            if k.endswith('.draw'))
+        parts.append('redraws {}'.format(redraws))
+        return ' '.join(parts)
+
+    def draw_overlay(self, game):
+        '''
+        Draws overlay_text on the second line of the game screen
+        '''
+        screen = game.screen
+        y, x = screen.getmaxyx()
+        if y < 3:
+            return
+        # Padded to clear the rest of the line of earlier text
+        screen.addstr(1, 0, self.overlay_text()[:x - 1].rjust(x - 1))
+
+    def summary(self):
+        '''
+        Returns a dict of totals: name to count, total, mean and maximum
+        milliseconds
+        '''
+        return {
+            name: {
+                'count': count,
+                'total_ms': total * 1000,
+                'mean_ms': total * 1000 / count,
+                'max_ms': longest * 1000,
+            }
+            for name, (count, total, longest) in sorted(self.totals.items())
+        }
+
+    def trace(self):
+        '''
+        Returns recorded events in Chrome trace event format
+        '''
+        pid = os.getpid()
+        start = self.start
+        events = [{
+            'name': name,
+            'cat': cat,
+            'ph': 'X',
+            'ts': (t - start) * 1e6,
+            'dur': dur * 1e6,
+            'pid': pid,
+            'tid': 0,
+        } for name, cat, t, dur in self.events]
+
+        return {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': { 'summary': self.summary() },
+        }
+
+    def write_trace(self, path = None):
+        path = path or self.trace_path
+        with open(path, 'w') as f:
+            json.dump(self.trace(), f)
+
+def from_environ(environ = os.environ):
+    '''
+    Returns a Recorder configured by environment variables,
+    or None if instrumentation is not enabled
+    '''
+    trace_path = environ.get('FREECELL_TRACE') or None
+    overlay = environ.get('FREECELL_OVERLAY', '') not in ('', '0')
+
+    if trace_path is None and not overlay:
+        return None
+    return Recorder(trace_path, overlay)
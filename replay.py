@@ -0,0 +1,261 @@
+#!/usr/bin/python3
+# -*- coding: utf-8
+
+'''
+Compact binary game records, and tools to replay and verify them.
+
+A record file begins with MAGIC, followed by any number of records.
+Each record is a header of deal number, game time in seconds, and the
+length of its move data, followed by the move data.
+
+Moves are encoded in one byte: the high four bits are the source slot and
+the low four bits the destination slot. Slots 0-3 are reserve slots 0-3,
+slots 4-11 are tableau slots 0-7, and slot 12 is the foundation.
+A move of more than one card is preceded by the byte 0xf0 | n.
+'''
+
+from collections import namedtuple
+import fcntl
+import os
+import struct
+import sys
+
+from freecell import *
+
+__all__ = [
+    'INVALID', 'MAGIC', 'UNFINISHED', 'WON',
+    'Record', 'append_record', 'decode_moves', 'encode_moves', 'position',
+    'read_records', 'replay', 'resolve_move', 'verify', 'verify_records',
+    'write_record',
+]
+
+MAGIC = b'FCGR\x01'
+
+WON = 'won'
+UNFINISHED = 'unfinished'
+INVALID = 'invalid'
+
+_HEADER = struct.Struct('<IIH')
+
+_GROUP_PREFIX = 0xf0
+
+_SLOTS = [(RESERVE, i) for i in range(4)] + \
+    [(TABLEAU, i) for i in range(8)] + [(FOUNDATION, None)]
+_CODES = { (kind, i): code for code, (kind, i) in enumerate(_SLOTS) }
+
+class Record(namedtuple('Record', 'deal time moves')):
+
+    '''
+    A game record: deal number, game time in seconds, and the bytes of
+    its encoded moves
+    '''
+
+    __slots__ = ()
+
+def encode_moves(moves):
+    '''
+    Returns the encoding of an iterable of Moves as bytes
+    '''
+    data = bytearray()
+
+    for src, a, dest, b, n in moves:
+        if n != 1:
+            if not 1 < n < 16:
+                raise ValueError('cannot encode move of {} cards'.format(n))
+            data.append(_GROUP_PREFIX | n)
+        if dest == FOUNDATION:
+            b = None
+        data.append(_CODES[src, a] << 4 | _CODES[dest, b])
+
+    return bytes(data)
+
+def decode_moves(data):
+    '''
+    Yields the Moves encoded in data. Moves to foundation are yielded with
+    a dest_index of None, since it depends on the card moved; replay fills
+    it in. Raises ValueError if data is malformed.
+    '''
+    n = 1
+
+    for byte in data:
+        if byte & 0xf0 == _GROUP_PREFIX:
+            if n != 1:
+                raise ValueError('repeated group prefix')
+            n = byte & 0x0f
+            continue
+
+        try:
+            src, a = _SLOTS[byte >> 4]
+            dest, b = _SLOTS[byte & 0x0f]
+        except IndexError:
+            raise ValueError('invalid move byte: {:#04x}'.format(byte))
+        if src == FOUNDATION:
+            raise ValueError('invalid move byte: {:#04x}'.format(byte))
+
+        yield Move(src, a, dest, b, n)
+        n = 1
+
+    if n != 1:
+        raise ValueError('truncated move data')
+
+def replay(record):
+    '''
+    Replays a record, yielding its FreeCell after each move.
+    The same FreeCell is yielded each time, so as not to copy it.
+    Raises ValueError on malformed data, and InvalidMove or MoveFromEmpty
+    on an illegal move.
+    '''
+    fc = FreeCell(deal(record.deal))
+
+    for move in decode_moves(record.moves):
+        fc.apply(resolve_move(fc, move))
+        yield fc
+
+def resolve_move(fc, move):
+    '''
+    Returns a decoded Move with the dest_index of a move to foundation
+    filled in from the card it moves in FreeCell fc.
+    Raises MoveFromEmpty if there is no card to move, or InvalidMove
+    if the source is not a reserve or tableau slot.
+    '''
+    if move.src not in (RESERVE, TABLEAU):
+        raise InvalidMove
+    if move.dest != FOUNDATION:
+        return move
+
+    if move.src == RESERVE:
+        c = fc.reserve[move.src_index]
+    elif fc.tableau[move.src_index]:
+        c = fc.tableau[move.src_index].top()
+    else:
+        c = None
+    if c is None:
+        raise MoveFromEmpty
+    return move._replace(dest_index = c.face_index)
+
+def position(record, n = None):
+    '''
+    Returns the FreeCell resulting from the first n moves of a record,
+    or all moves if n is None
+    '''
+    fc = FreeCell(deal(record.deal))
+    if n != 0:
+        for i, fc in enumerate(replay(record), 1):
+            if i == n:
+                break
+    return fc
+
+def verify(record):
+    '''
+    Replays a record and returns (status, moves), where status is one of
+    WON, UNFINISHED, or INVALID and moves is the number of legal moves
+    '''
+    moves = 0
+    fc = None
+
+    try:
+        for fc in replay(record):
+            moves += 1
+    except (ValueError, InvalidMove, MoveFromEmpty):
+        return INVALID, moves
+
+    if fc is not None and fc.won():
+        return WON, moves
+    return UNFINISHED, moves
+
+def write_record(f, record):
+    '''
+    Writes a Record to a binary file. MAGIC is written first if the file
+    is empty. Raises ValueError, writing nothing, if the deal number, time,
+    or length of the moves is too large for the record header.
+    '''
+    data = _pack_record(record)
+    if f.tell() == 0:
+        f.write(MAGIC)
+    f.write(data)
+
+def append_record(path, record):
+    '''
+    Appends a Record to a record file, creating it if it does not exist,
+    in a single write under an exclusive lock, so that several sessions
+    may share one file. Raises ValueError, writing nothing, if the record
+    is too large, as does write_record.
+    '''
+    data = _pack_record(record)
+
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        # Released when fd is closed
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        if os.fstat(fd).st_size == 0:
+            data = MAGIC + data
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+
+def _pack_record(record):
+    try:
+        header = _HEADER.pack(record.deal, record.time, len(record.moves))
+    except struct.error:
+        raise ValueError('game too large to record')
+    return header + record.moves
+
+def read_records(f):
+    '''
+    Yields each Record in a binary file, reading one at a time.
+    Raises ValueError if the file is not a record file or is truncated.
+    '''
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('not a game record file')
+
+    while True:
+        header = f.read(_HEADER.size)
+        if not header:
+            return
+        if len(header) != _HEADER.size:
+            raise ValueError('truncated record')
+        deal_number, time, size = _HEADER.unpack(header)
+        moves = f.read(size)
+        if len(moves) != size:
+            raise ValueError('truncated record')
+        yield Record(deal_number, time, moves)
+
+def verify_records(records):
+    '''
+    Yields (record, status, moves) for each of an iterable of Records
+    '''
+    for record in records:
+        yield (record,) + verify(record)
+
+def main(argv = None):
+    # Imported here, since the game imports this module at startup
+    import argparse
+
+    parser = argparse.ArgumentParser(prog = 'replay.py',
+        description = 'Verify FreeCell game records')
+    parser.add_argument('file', help = 'game record file')
+    parser.add_argument('--verbose', '-v', action = 'store_true',
+        help = 'print the result of each record')
+
+    args = parser.parse_args(argv)
+
+    counts = dict.fromkeys((WON, UNFINISHED, INVALID), 0)
+
+    try:
+        with open(args.file, 'rb') as f:
+            for record, status, moves in verify_records(read_records(f)):
+                counts[status] += 1
+                if args.verbose:
+                    print('deal {} {} after {} moves in {}s'.format(
+                        record.deal, status, moves, record.time))
+    except (OSError, ValueError) as e:
+        print('{}: {}'.format(parser.prog, e), file = sys.stderr)
+        return 1
+
+    print('{} won, {} unfinished, {} invalid'.format(
+        counts[WON], counts[UNFINISHED], counts[INVALID]))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
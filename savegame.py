@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+# -*- coding: utf-8
+
+'''
+Games in progress, saved when the player quits and resumed on launch.
+
+A save file is MAGIC, followed by a header of deal number, game time in
+seconds, number of undos, number of undo entries, and number of entries
+applied, then groups of moves: those made by sweeping before the first
+player move, then each undo entry. Each group is its length in bytes,
+followed by its moves encoded as in replay.
+
+Each saved game is a separate file in a save directory, so that sessions
+quitting at once do not overwrite one another's games. A game is resumed
+by at most one session: the file is removed when it is loaded, and a
+session which fails to remove it leaves the game to the session which did.
+'''
+
+from collections import namedtuple
+import os
+import struct
+import time
+
+from freecell import *
+from replay import decode_moves, encode_moves, resolve_move
+
+__all__ = [
+    'MAGIC', 'SavedGame', 'decode', 'encode', 'load_latest', 'restore',
+    'save',
+]
+
+MAGIC = b'FCSV\x01'
+
+_HEADER = struct.Struct('<IIHHH')
+_LENGTH = struct.Struct('<H')
+
+# Marks an undo index of None: all entries are applied
+_ALL_APPLIED = 0xffff
+
+_SUFFIX = '.sav'
+
+class SavedGame(namedtuple('SavedGame',
+        'deal time undos start_moves undo_list undo_index')):
+
+    '''
+    A game in progress: deal number, game time in seconds, number of undos,
+    moves made by sweeping before the first player move, undo list,
+    and undo index, as kept by FreeCellGame
+    '''
+
+    __slots__ = ()
+
+def encode(saved):
+    '''
+    Returns the encoding of a SavedGame as bytes. Raises ValueError
+    if the game is too large to be encoded.
+    '''
+    n = len(saved.undo_list)
+    index = _ALL_APPLIED if saved.undo_index is None else saved.undo_index
+    if n >= _ALL_APPLIED:
+        raise ValueError('too many undo entries to save')
+
+    data = bytearray(MAGIC)
+    try:
+        data += _HEADER.pack(saved.deal, saved.time,
+            min(saved.undos, 0xffff), n, index)
+
+        for moves in [saved.start_moves] + saved.undo_list:
+            moves = encode_moves(moves)
+            data += _LENGTH.pack(len(moves))
+            data += moves
+    except struct.error:
+        raise ValueError('game too large to save')
+
+    return bytes(data)
+
+def decode(data):
+    '''
+    Returns the SavedGame encoded in data, with each group of moves left
+    encoded as bytes; restore decodes them. Raises ValueError if the header
+    or the lengths of groups are malformed.
+    '''
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('not a saved game')
+
+    try:
+        deal_number, t, undos, n, index = _HEADER.unpack_from(data,
+            len(MAGIC))
+        offset = len(MAGIC) + _HEADER.size
+
+        groups = []
+        for i in range(n + 1):
+            size, = _LENGTH.unpack_from(data, offset)
+            offset += _LENGTH.size
+            moves = data[offset:offset + size]
+            if len(moves) != size:
+                raise ValueError('truncated saved game')
+            groups.append(moves)
+            offset += size
+    except struct.error:
+        raise ValueError('truncated saved game')
+
+    if offset != len(data) or (index != _ALL_APPLIED and index > n):
+        raise ValueError('invalid saved game')
+
+    return SavedGame(deal_number, t, undos, groups[0], groups[1:],
+        None if index == _ALL_APPLIED else index)
+
+def restore(fc, saved):
+    '''
+    Applies the moves of a SavedGame returned by decode to fc, a FreeCell
+    of its deal, and returns (start_moves, undo_list) as lists of Moves.
+    Entries after the undo index are applied to fill in moves to foundation,
+    then reverted. Raises ValueError if any move is malformed or cannot be
+    replayed; the game cannot then be resumed, but its header is still
+    known.
+    '''
+    groups = []
+    try:
+        for moves in [saved.start_moves] + saved.undo_list:
+            group = []
+            for move in decode_moves(moves):
+                move = resolve_move(fc, move)
+                fc.apply(move)
+                group.append(move)
+            groups.append(group)
+    except (InvalidMove, MoveFromEmpty, LookupError, TypeError):
+        # Moves from a damaged file may name slots which do not exist;
+        # any failure to replay them means the save cannot be resumed.
+        raise ValueError('invalid move in saved game')
+
+    if saved.undo_index is not None:
+        for group in reversed(groups[saved.undo_index + 1:]):
+            for move in reversed(group):
+                fc.revert(move)
+
+    return groups[0], groups[1:]
+
+def save(directory, saved):
+    '''
+    Writes a SavedGame to a new file in directory, which is created
+    if it does not exist. Returns once the file is on disk.
+    '''
+    os.makedirs(directory, 0o755, exist_ok = True)
+
+    name = os.path.join(directory,
+        '{:020d}-{}'.format(time.time_ns(), os.getpid()))
+    tmp = name + '.tmp'
+
+    data = encode(saved)
+
+    # Written in full before it is given the name load_latest looks for
+    f = open(tmp, 'wb')
+    try:
+        with f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, name + _SUFFIX)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def load_latest(directory):
+    '''
+    Removes the most recently saved game in directory and returns it
+    decoded, or returns None if there is none. Raises ValueError
+    if the file is not a valid saved game; it is removed regardless.
+    '''
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return None
+
+    for name in sorted((n for n in names if n.endswith(_SUFFIX)),
+            reverse = True):
+        path = os.path.join(directory, name)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.unlink(path)
+        except FileNotFoundError:
+            # Resumed by another session
+            continue
+        return decode(data)
+
+    return None
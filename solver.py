@@ -0,0 +1,445 @@
+#!/usr/bin/python3
+# -*- coding: utf-8
+
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+import heapq
+import itertools
+import sys
+import time
+
+from freecell import *
+
+__all__ = [
+    'SOLVED', 'UNSOLVABLE', 'UNKNOWN',
+    'PositionCache', 'Result', 'Search', 'solve',
+]
+
+SOLVED = 'solved'
+UNSOLVABLE = 'unsolvable'
+UNKNOWN = 'unknown'
+
+DEFAULT_MAX_NODES = 200000
+DEFAULT_MAX_TIME = 10
+DEFAULT_CACHE_BYTES = 32 << 20
+
+class Result(object):
+
+    '''
+    Result of a solver search.
+
+    status is one of SOLVED, UNSOLVABLE, or UNKNOWN (search budget exhausted).
+    moves is the list of Moves which wins the game, or None if no
+    solution was found; see solve for details.
+    '''
+
+    def __init__(self, status, moves, nodes, elapsed):
+        self.status = status
+        self.moves = moves
+        self.nodes = nodes
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        return '<Result {} moves={} nodes={} elapsed={:.3f}>'.format(
+            self.status, None if self.moves is None else len(self.moves),
+            self.nodes, self.elapsed)
+
+    @property
+    def solved(self):
+        return self.status == SOLVED
+
+class Entry(namedtuple('Entry', 'status distance move')):
+
+    '''
+    A PositionCache entry. A SOLVED entry records the number of player moves
+    needed to win and the first of them, encoded by _encode_move.
+    '''
+
+    __slots__ = ()
+
+# Approximate memory used by a cache entry, besides its key:
+# the dict slot and linked list node of OrderedDict, Entry, and move tuple
+_ENTRY_OVERHEAD = 240
+
+class PositionCache(object):
+
+    '''
+    A least recently used cache of solver results, keyed by canonical
+    position key, and limited to approximately max_bytes of memory.
+
+    Every position along a solution is cached, so that the solution is
+    found again from any of them, whichever slots the cards occupy.
+    hits and misses count calls to lookup.
+    '''
+
+    def __init__(self, max_bytes = DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return '<PositionCache entries={} size={} hits={} misses={}>'.format(
+            len(self.entries), self.size, self.hits, self.misses)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def get(self, key):
+        '''
+        Returns the Entry for a canonical key, or None
+        '''
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        entries = self.entries
+        if key in entries:
+            entries.move_to_end(key)
+        else:
+            self.size += sys.getsizeof(key) + _ENTRY_OVERHEAD
+        entries[key] = entry
+
+        while self.size > self.max_bytes and entries:
+            old, _ = entries.popitem(last = False)
+            self.size -= sys.getsizeof(old) + _ENTRY_OVERHEAD
+
+    def lookup(self, fc):
+        '''
+        Returns (SOLVED, moves) or (UNSOLVABLE, None) for a position,
+        which is expected to be swept, or None if its result is not cached.
+        Moves are as described by solve.
+        '''
+        entry = self.get(fc.key(True))
+
+        if entry is None:
+            res = None
+        elif entry.status == UNSOLVABLE:
+            res = (UNSOLVABLE, None)
+        else:
+            moves = self._follow(fc, entry)
+            res = None if moves is None else (SOLVED, moves)
+
+        if res is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return res
+
+    def _follow(self, fc, entry):
+        # Replays cached moves from fc until the game is won; returns None
+        # if any position along the way has been evicted.
+        node = fc.copy()
+        moves = []
+
+        while True:
+            move = _decode_move(node, entry.move)
+            if move is None:
+                return None
+            node.apply(move)
+            node.sweep()
+            moves.append(move)
+
+            if node.won():
+                return moves
+
+            distance = entry.distance
+            entry = self.get(node.key(True))
+            if entry is None or entry.status != SOLVED or \
+                    entry.distance >= distance:
+                return None
+
+    def store(self, fc, status, moves):
+        '''
+        Records the result of a search from a swept position
+        '''
+        if status == UNSOLVABLE:
+            self.put(fc.key(True), Entry(UNSOLVABLE, None, None))
+        elif status == SOLVED:
+            node = fc.copy()
+            path = []
+            for i, move in enumerate(moves):
+                path.append((node.key(True),
+                    Entry(SOLVED, len(moves) - i, _encode_move(node, move))))
+                node.apply(move)
+                node.sweep()
+            # Insert the starting position last, so it is evicted last
+            for key, entry in reversed(path):
+                self.put(key, entry)
+
+def _encode_move(fc, move):
+    # Moves are cached in terms of cards rather than slots, which may differ
+    # between positions with equal canonical keys: (card index, n, dest,
+    # index of the card moved onto, or None).
+    if move.src == RESERVE:
+        c = fc.reserve[move.src_index]
+    else:
+        c = fc.tableau[move.src_index].nth(move.n)
+
+    onto = None
+    if move.dest == TABLEAU:
+        t = fc.tableau[move.dest_index]
+        if t:
+            onto = t.top().index
+
+    return (c.index, move.n, move.dest, onto)
+
+def _decode_move(fc, m):
+    # Returns the Move in fc for a move encoded by _encode_move,
+    # or None if it does not apply to fc.
+    index, n, dest, onto = m
+    c = DECK[index]
+    loc = fc.locate(c)
+
+    if loc is None or loc[0] == FOUNDATION:
+        return None
+    src, src_index = loc
+    if src == TABLEAU:
+        t = fc.tableau[src_index]
+        if n > len(t) or t.nth(n) is not c:
+            return None
+
+    if dest == RESERVE:
+        if not fc.reserve_free():
+            return None
+        dest_index = fc.reserve.index(None)
+    elif dest == FOUNDATION:
+        dest_index = c.face_index
+    elif onto is None:
+        for dest_index, t in enumerate(fc.tableau):
+            if not t:
+                break
+        else:
+            return None
+    else:
+        loc = fc.locate(DECK[onto])
+        if loc is None or loc[0] != TABLEAU:
+            return None
+        dest_index = loc[1]
+
+    return Move(src, src_index, dest, dest_index, n)
+
+class Search(object):
+
+    '''
+    An incremental best-first search for a solution to a FreeCell position,
+    which is not modified.
+
+    Positions are expanded by calls to run, each of which may be limited
+    in the number of positions or time it takes, so that a search may be
+    interleaved with other work. status is None until the search completes.
+    See solve for the meaning of the resulting moves.
+
+    If a PositionCache is given, the search ends as soon as it reaches
+    a position whose result is cached, and its own result is cached
+    when it completes.
+
+    If partial is False, groups are only moved to empty tableau slots as
+    a whole; see FreeCell.legal_moves. A cache must not be shared between
+    searches with different values of partial.
+    '''
+
+    def __init__(self, fc, cache = None, partial = True):
+        self.status = None
+        self.moves = None
+        self.nodes = 0
+        self.elapsed = 0
+        self.cache = cache
+        self.partial = partial
+
+        # Positions waiting to be expanded are kept as their parent,
+        # which all its children share, and the move from it, so that
+        # the heap holds a snapshot only of each expanded position.
+        root = PersistentFreeCell.from_key(fc.key())
+        root.sweep()
+        self.root = root
+
+        root_key = root.key(True)
+        # Maps canonical key to (parent canonical key, move)
+        self.parents = { root_key: None }
+        self.counter = itertools.count()
+        h = heuristic(root)
+        self.heap = [(h, next(self.counter), root_key, root, None)]
+        # Heuristic value and canonical key of the most promising position
+        self.best = (h, root_key)
+
+        if root.won():
+            self.status = SOLVED
+            self.moves = []
+            self.heap = []
+        elif cache is not None:
+            res = cache.lookup(root)
+            if res is not None:
+                self.status, self.moves = res
+                self.heap = []
+
+    def run(self, max_nodes = None, deadline = None):
+        '''
+        Expands up to max_nodes positions, stopping early once
+        time.perf_counter() reaches deadline. Either may be None.
+        Returns status.
+        '''
+        if self.status is not None:
+            return self.status
+
+        start = time.perf_counter()
+        parents = self.parents
+        counter = self.counter
+        heap = self.heap
+        cache = self.cache
+        partial = self.partial
+        best_h, best_key = self.best
+        n = 0
+
+        try:
+            while heap:
+                if max_nodes is not None and n >= max_nodes:
+                    break
+                if deadline is not None and time.perf_counter() >= deadline:
+                    break
+
+                _, _, ckey, parent, prev = heapq.heappop(heap)
+                node = parent.copy()
+                if prev is not None:
+                    node.apply(prev)
+                    node.sweep()
+                n += 1
+
+                for move in node.legal_moves(prev, distinct = True,
+                        partial = partial):
+                    swept = []
+                    node.apply(move)
+                    node.sweep(swept)
+
+                    child_ckey = node.key(True)
+                    if child_ckey not in parents:
+                        parents[child_ckey] = (ckey, move)
+
+                        if node.won():
+                            self.finish(SOLVED, _trace(parents, child_ckey))
+                            best_key = child_ckey
+                            return self.status
+
+                        res = None
+                        if cache is not None and child_ckey in cache:
+                            res = cache.lookup(node)
+
+                        if res is None:
+                            h = heuristic(node)
+                            if h < best_h:
+                                best_h, best_key = h, child_ckey
+                            heapq.heappush(heap,
+                                (h, next(counter), child_ckey, node, move))
+                        elif res[0] == SOLVED:
+                            self.finish(SOLVED,
+                                _trace(parents, child_ckey) + res[1])
+                            best_key = child_ckey
+                            return self.status
+                        # Otherwise, the position is known to be unsolvable
+                        # and is not searched again.
+
+                    for m in reversed(swept):
+                        node.revert(m)
+                    node.revert(move)
+
+            if not heap:
+                self.finish(UNSOLVABLE, None)
+            return self.status
+        finally:
+            self.best = (best_h, best_key)
+            self.nodes += n
+            self.elapsed += time.perf_counter() - start
+
+    def finish(self, status, moves):
+        '''
+        Completes the search with the given result
+        '''
+        self.status = status
+        self.moves = moves
+        self.heap = []
+        if self.cache is not None:
+            self.cache.store(self.root, status, moves)
+
+    def best_moves(self):
+        '''
+        Returns the winning moves, if a solution has been found;
+        otherwise, the moves leading to the most promising position
+        found so far, which improve as the search progresses
+        '''
+        if self.moves is not None:
+            return self.moves
+        return _trace(self.parents, self.best[1])
+
+    def result(self):
+        '''
+        Returns a Result; an incomplete search is reported as UNKNOWN
+        '''
+        return Result(self.status or UNKNOWN, self.moves,
+            self.nodes, self.elapsed)
+
+def solve(fc, max_nodes = DEFAULT_MAX_NODES, max_time = DEFAULT_MAX_TIME,
+        cache = None):
+    '''
+    Searches for a solution to the given FreeCell position, which is not
+    modified. Returns a Result.
+
+    The search is a best-first search over positions, identified by their
+    canonical key. Cards which are safe to move to foundation are swept
+    automatically after every move, just as in the game; the returned moves
+    therefore only include player moves and each must be followed by a call
+    to FreeCell.sweep. The initial position is swept before the first move.
+
+    The search gives up, returning UNKNOWN, after expanding max_nodes
+    positions or running for max_time seconds. Either may be None.
+
+    If cache is a PositionCache, cached results are used and updated.
+    '''
+    deadline = None if max_time is None else time.perf_counter() + max_time
+    search = Search(fc, cache)
+    search.run(max_nodes, deadline)
+    return search.result()
+
+def _trace(parents, ckey):
+    path = []
+    while parents[ckey] is not None:
+        ckey, move = parents[ckey]
+        path.append(move)
+    path.reverse()
+    return path
+
+def heuristic(fc):
+    '''
+    Returns an estimate of the remaining effort to solve a position.
+    Lower values are better.
+    '''
+    h = sum(map(_column_cost, fc.column_keys))
+    left = 52 - sum(len(f) for f in fc.foundation)
+    used = fc.RESERVE_SLOTS - fc.free_cells
+
+    return left * 2 + h * 3 + used - fc.empty_columns
+
+@lru_cache(maxsize = 1 << 16)
+def _column_cost(col):
+    # Counts cards lying on top of a lower card of the same suit in a
+    # tableau column, given as in FreeCell.column_keys; each must be moved
+    # at least once more before that card is freed. Columns recur across
+    # many positions, so their costs are cached.
+    h = 0
+    low = [14] * len(Card.FACES)
+    for i in col:
+        c = DECK[i - 1]
+        if c.value > low[c.face_index]:
+            h += 1
+        elif c.value < low[c.face_index]:
+            low[c.face_index] = c.value
+    return h